@@ -0,0 +1,349 @@
+# This file is part of dbc.
+#
+# dbc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbc.  If not, see <http://www.gnu.org/licenses/>.
+
+# What @dbc costs: every benchmark times a decorated callable against the
+# same code undecorated and reports the time per call and the ratio of the
+# two; the memory per instance of a few classes is reported alongside.
+# Results are written as JSON; given the results of an earlier run with
+# --baseline, overheads that grew by more than --tolerance are reported and
+# make the run fail.
+#
+#   python bench.py --output new.json --baseline old.json
+
+from __future__ import print_function
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import timeit
+
+from dbc import dbc
+
+_benchmarks = []
+
+
+def benchmark(name):
+    # a benchmark returns (decorated, undecorated), two callables without
+    # arguments doing the same work
+    def register(setup):
+        _benchmarks.append((name, setup))
+        return setup
+    return register
+
+
+def _function(decorate):
+    def add(a, b):
+        """
+        pre: a >= 0
+        pre: b >= 0
+        post: __ret__ >= a
+        """
+        return a + b
+    return decorate(add)
+
+
+@benchmark("function")
+def _bench_function():
+    f, g = _function(dbc), _function(lambda f: f)
+    return lambda: f(1, 2), lambda: g(1, 2)
+
+
+def _method_class(decorate):
+    class Account(object):
+        def __init__(self):
+            self.balance = 0
+
+        def deposit(self, amount):
+            """
+            pre: amount > 0
+            post: self.balance == __old__["self"].balance + amount
+            """
+            self.balance += amount
+            return self.balance
+
+        def __dbc_snapshot__(self):
+            a = Account.__new__(Account)
+            a.__dict__.update(self.__dict__)
+            return a
+    return decorate(Account)
+
+
+@benchmark("method")
+def _bench_method():
+    a, b = _method_class(dbc)(), _method_class(lambda c: c)()
+    return lambda: a.deposit(1), lambda: b.deposit(1)
+
+
+def _sort(decorate):
+    def mysort(a):
+        """
+        pre: len(a) >= 0
+        post: len(__ret__) == len(__old__["a"])
+        post: sorted(__old__["a"]) == __ret__
+        post: id(__ret__) == id(a)
+        """
+        a.sort()
+        return a
+    return decorate(mysort)
+
+
+def _bench_old(size):
+    def setup():
+        data = [random.random() for i in range(size)]
+        f, g = _sort(dbc), _sort(lambda f: f)
+        return lambda: f(list(data)), lambda: g(list(data))
+    return setup
+
+
+for _size in (10, 100, 1000, 10000):
+    benchmark("old_list_%d" % _size)(_bench_old(_size))
+
+
+def _invariant_class(decorate, count, shared):
+    # count invariants, each on an attribute of its own, or all of them on
+    # the one attribute that is assigned
+    doc = "\n".join("hinv: self.a%d >= %d" % (0 if shared else i, -i) for i in range(count))
+
+    def __init__(self):
+        for i in range(count):
+            setattr(self, "a%d" % i, i)
+    return decorate(type("Many", (object,), {"__doc__": doc, "__init__": __init__}))
+
+
+def _bench_invariants(count, shared):
+    def setup():
+        a, b = _invariant_class(dbc, count, shared)(), _invariant_class(lambda c: c, count, shared)()
+
+        def assign_a():
+            a.a0 = 1
+
+        def assign_b():
+            b.a0 = 1
+        return assign_a, assign_b
+    return setup
+
+
+benchmark("hinv_assign_20")(_bench_invariants(20, False))
+benchmark("hinv_assign_20_shared")(_bench_invariants(20, True))
+
+
+@benchmark("hinv_read")
+def _bench_read():
+    # reading attributes invariants depend on, which usually happens far
+    # more often than assigning them
+    a, b = _point(dbc, False), _point(lambda c: c, False)
+    return lambda: a.x + a.y, lambda: b.x + b.y
+
+
+def _mutator_class(decorate, fields):
+    # a method assigning fields attributes, each with an invariant
+    doc = "\n".join("hinv: self.a%d >= 0" % i for i in range(fields))
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for i in range(fields):
+            setattr(self, "a%d" % i, i)
+    return decorate(type("Mutator", (object,), {"__doc__": doc, "__init__": __init__,
+                                                 "reset": reset}))
+
+
+def _bench_mutator(fields, invariants):
+    def setup():
+        a = _mutator_class(lambda c: dbc(c, invariants=invariants), fields)()
+        b = _mutator_class(lambda c: c, fields)()
+        return a.reset, b.reset
+    return setup
+
+
+benchmark("mutate_10_assignments")(_bench_mutator(10, "assignments"))
+benchmark("mutate_10_methods")(_bench_mutator(10, "methods"))
+
+
+def _hierarchy(decorate, depth, methods):
+    # a chain of depth classes, each adding methods with conditions and an
+    # invariant
+    base = object
+    for d in range(depth):
+        namespace = {"__doc__": "hinv: self.x >= %d" % -d}
+        for m in range(methods):
+            def method(self, y):
+                """
+                pre: y >= 0
+                post: __ret__ >= y
+                """
+                return self.x + y
+            method.__name__ = "m%d_%d" % (d, m)
+            namespace[method.__name__] = method
+        base = decorate(type("C%d" % d, (base,), namespace))
+
+    def __init__(self):
+        self.x = 0
+    return decorate(type("Leaf", (base,), {"__init__": __init__}))
+
+
+def _bench_construct(depth, methods):
+    def setup():
+        return _hierarchy(dbc, depth, methods), _hierarchy(lambda c: c, depth, methods)
+    return setup
+
+
+benchmark("construct_depth_10")(_bench_construct(10, 10))
+
+
+def _bench_threads(count, calls=16000):
+    # the same number of calls, split between count threads: the time of
+    # the decorated function going down with more threads means it scales
+    def setup():
+        f, g = _function(dbc), _function(lambda f: f)
+
+        def spread(h):
+            def work():
+                for i in range(calls // count):
+                    h(i, 1)
+
+            def run():
+                threads = [threading.Thread(target=work) for i in range(count)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            return run
+        return spread(f), spread(g)
+    return setup
+
+
+for _count in (1, 2, 4, 8):
+    benchmark("threads_%d" % _count)(_bench_threads(_count))
+
+
+def _point(decorate, slots):
+    namespace = {"__doc__": "hinv: self.x <= self.y"}
+    if slots:
+        namespace["__slots__"] = ("x", "y")
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+    namespace["__init__"] = __init__
+    return decorate(type("Point", (object,), namespace))(1, 2)
+
+
+# instances whose memory is reported, decorated and undecorated
+_instances = [
+    ("point", lambda decorate: _point(decorate, False)),
+    ("point_slots", lambda decorate: _point(decorate, True)),
+]
+
+
+def _instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def _time(f, repeat, target):
+    # seconds per call, the best of repeat runs of about target seconds
+    number = 1
+    while True:
+        t = timeit.timeit(f, number=number)
+        if t >= target / 10:
+            break
+        number *= 10
+    number = max(1, int(number * target / t))
+    return min(timeit.repeat(f, number=number, repeat=repeat)) / number
+
+
+def run(names=None, repeat=5, target=0.2):
+    results = {}
+    for name, setup in _benchmarks:
+        if names and name not in names:
+            continue
+        decorated, undecorated = setup()
+        seconds = _time(decorated, repeat, target)
+        baseline = _time(undecorated, repeat, target)
+        results[name] = {"seconds": seconds, "baseline": baseline,
+                         "overhead": seconds / baseline}
+    memory = {}
+    for name, create in _instances:
+        memory[name] = {"bytes": _instance_size(create(dbc)),
+                        "baseline": _instance_size(create(lambda c: c))}
+    return {"python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "results": results, "memory": memory}
+
+
+def compare(current, stored, tolerance):
+    # the benchmarks whose overhead grew by more than tolerance; overheads
+    # are ratios to the undecorated code, so they can be compared between
+    # machines more reliably than times
+    regressions = []
+    for name, result in sorted(current["results"].items()):
+        old = stored["results"].get(name)
+        if old is not None and result["overhead"] > old["overhead"] * (1 + tolerance):
+            regressions.append((name, old["overhead"], result["overhead"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the overhead of @dbc.")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="compare against the results in this file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative growth of the overhead (default: 0.25)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--target", type=float, default=0.2,
+                        help="seconds per timing run (default: 0.2)")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, _ in _benchmarks:
+            print(name)
+        return 0
+
+    results = run(args.names, args.repeat, args.target)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    for name, result in sorted(results["results"].items()):
+        print("%-24s %12.3f us %8.2fx" % (name, result["seconds"] * 1e6, result["overhead"]),
+              file=sys.stderr)
+    for name, result in sorted(results["memory"].items()):
+        print("%-24s %9d bytes per instance (%d undecorated)" % (name, result["bytes"], result["baseline"]),
+              file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        regressions = compare(results, stored, args.tolerance)
+        for name, old, new in regressions:
+            print("regression: %s overhead %.2fx -> %.2fx" % (name, old, new), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
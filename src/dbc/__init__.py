@@ -14,16 +14,409 @@
 # along with dbc.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
+import ast
+import collections
+import copy
 import inspect
+import logging
+import os
+import re
+import threading
+import types
+import weakref
 from functools import wraps
-import copy
+try:
+    import builtins as _builtins
+except ImportError:
+    import __builtin__ as _builtins
+from .snapshot import snapshot, register_snapshot, set_snapshot_limit, \
+    get_snapshot_limit, Fingerprint, NO_SNAPSHOT
+from .profiling import profile, print_profile, reset_profile
+from . import profiling as _profiler
+from . import cache as _cache
+from .cache import set_cache_dir, get_cache_dir, cache_info, clear_cache
+from . import deferred as _deferred
+from .deferred import set_deferred, deferred_info, flush
+from . import report as _report
+from . import optimize as _optimize
+from .report import violations, reset_violations
+from .predicates import predicates as _predicates, is_sorted, non_negative, \
+    all_finite, within_bounds, same_shape, is_permutation, unchanged_except
+
 
+_options_pattern = re.compile(r"\[([^\]]*)\]:")
 
-def __getLinesStartingWith(prefix, lines):
+
+def __getConditionLines(kind, lines):
+    # yields text and options of every "<kind>: <text>" and
+    # "<kind>[<options>]: <text>" line
     for line in lines.splitlines():
         line = line.lstrip()
-        if line.startswith(prefix):
-            yield line[len(prefix):].strip()
+        if line.startswith(kind + ":"):
+            yield line[len(kind) + 1:].strip(), ""
+        elif line.startswith(kind + "["):
+            match = _options_pattern.match(line, len(kind))
+            if match:
+                yield line[match.end():].strip(), match.group(1)
+
+
+def _parse_rate(rate):
+    rate = float(rate)
+    if not 0.0 <= rate <= 1.0:
+        raise ValueError("Sampling rate must be between 0 and 1, not %r" % rate)
+    return rate
+
+
+_budget_units = (("us", 1e-6), ("ms", 1e-3), ("s", 1.0))
+
+
+def _parse_budget(budget):
+    # (limit, relative): a budget is a multiple of the duration of the call
+    # ("2", "2x"), or a fixed time ("50us", "1ms", "0.5s")
+    if isinstance(budget, tuple):
+        return budget
+    text = str(budget).strip().lower()
+    relative, scale = True, 1.0
+    for unit, factor in _budget_units:
+        if text.endswith(unit):
+            text, relative, scale = text[:-len(unit)], False, factor
+            break
+    else:
+        if text.endswith("x"):
+            text = text[:-1]
+    limit = float(text) * scale
+    if not limit > 0.0:
+        raise ValueError("Budget must be positive, not %r" % (budget,))
+    return limit, relative
+
+
+def _parse_flag(value):
+    if value:
+        raise ValueError("Option takes no value, not %r" % value)
+    return True
+
+
+# options a single condition accepts, with their parsers
+_condition_options = {
+    "sample": _parse_rate,
+    "budget": _parse_budget,
+    "defer": _parse_flag,
+}
+
+
+def _parse_options(options):
+    result = {}
+    for option in options.split(","):
+        key, _, value = option.partition("=")
+        key = key.strip()
+        if not key:
+            continue
+        if key not in _condition_options:
+            raise AttributeError("Unknown condition option '%s'" % key)
+        result[key] = _condition_options[key](value.strip())
+    return result
+
+
+class _Sampler(object):
+    # counter based sampling: every call adds the rate to the credit, and a
+    # check is due whenever the credit reaches one
+    __slots__ = ("rate", "credit")
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.credit = 0.0
+
+    def sample(self, rate):
+        credit = self.credit + rate
+        if credit < 1.0:
+            self.credit = credit
+            return False
+        self.credit = credit - 1.0
+        return True
+
+
+# sub-expressions wrapped in old(...), keyed by their AST dump, mapped to
+# the name their value is stored under and their AST; identical old(...)
+# expressions share one evaluation per call
+_old_expressions = {}
+
+
+def _old_expression(node):
+    key = ast.dump(node)
+    try:
+        return _old_expressions[key]
+    except KeyError:
+        old = _old_expressions[key] = ("__old%d__" % len(_old_expressions), node)
+        return old
+
+
+class _OldTransformer(ast.NodeTransformer):
+    # replaces every old(<expr>) by a name the value of <expr> is stored
+    # under before the call
+    def __init__(self):
+        self.olds = []
+        # names bound by the lambdas and comprehensions around the node
+        # visited, which have no value before the call
+        self.bound = set()
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) and node.func.id == "old" and \
+                len(node.args) == 1 and not node.keywords and \
+                not getattr(node, "starargs", None) and not getattr(node, "kwargs", None):
+            for n in ast.walk(node.args[0]):
+                if isinstance(n, ast.Name) and n.id in self.bound:
+                    raise AttributeError("old() cannot use '%s', which is bound within the condition"
+                                         % n.id)
+            old = _old_expression(node.args[0])
+            if old not in self.olds:
+                self.olds.append(old)
+            return ast.copy_location(ast.Name(id=old[0], ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+    def _visit_bound(self, node, names):
+        bound = self.bound
+        self.bound = bound | names
+        try:
+            return self.visit(node)
+        finally:
+            self.bound = bound
+
+    def visit_Lambda(self, node):
+        # the defaults are evaluated outside of the lambda
+        node.args = self.visit(node.args)
+        args = node.args
+        names = set()
+        for arg in args.args + getattr(args, "kwonlyargs", []) + getattr(args, "posonlyargs", []):
+            # Python 2 has names, and tuples of them, instead of arguments
+            names.update([arg.arg] if hasattr(arg, "arg") else
+                         [n.id for n in ast.walk(arg) if isinstance(n, ast.Name)])
+        for extra in (args.vararg, args.kwarg):
+            if extra is not None:
+                names.add(getattr(extra, "arg", extra))
+        node.body = self._visit_bound(node.body, names)
+        return node
+
+    def _comprehension(self, node):
+        # the first iterable is evaluated outside of the comprehension
+        names = set(n.id for g in node.generators for n in ast.walk(g.target)
+                    if isinstance(n, ast.Name))
+        for i, g in enumerate(node.generators):
+            g.iter = self._visit_bound(g.iter, names) if i else self.visit(g.iter)
+            g.ifs = [self._visit_bound(c, names) for c in g.ifs]
+        for field in ("elt", "key", "value"):
+            if hasattr(node, field):
+                setattr(node, field, self._visit_bound(getattr(node, field), names))
+        return node
+
+    visit_GeneratorExp = visit_ListComp = visit_SetComp = visit_DictComp = _comprehension
+
+
+def _literal(node):
+    if isinstance(node, getattr(ast, "Index", ())):
+        node = node.value
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return None
+
+
+def _old_arguments(tree):
+    # the argument names looked up as __old__["name"]; None if __old__ is
+    # used in any other way and all arguments have to be remembered
+    names = set()
+    indexed = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and \
+                node.value.id == "__old__":
+            key = _literal(node.slice)
+            if isinstance(key, str):
+                names.add(key)
+                indexed.add(node.value)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "__old__" and node not in indexed:
+            return None
+    return frozenset(names)
+
+
+def _self_attributes(tree):
+    # the attribute names read as self.<name>; None if self is used in any
+    # other way (passed on, or a method called on it), so the condition may
+    # depend on any attribute
+    parents = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "self":
+            parent = parents.get(node)
+            if not isinstance(parent, ast.Attribute):
+                return None
+            call = parents.get(parent)
+            if isinstance(call, ast.Call) and call.func is parent:
+                return None
+            names.add(parent.attr)
+    return frozenset(names)
+
+
+class _Condition(object):
+    # the text is only parsed once the tree or anything derived from it is
+    # needed, which a wrapper found in the cache never does
+    __slots__ = ("text", "options", "tree", "function", "olds", "uses_old", "old_args", "rate",
+                 "budget", "deferred", "self_attrs")
+
+    def __init__(self, text, options=""):
+        self.text = text
+        self.options = options
+        parsed = _parse_options(options)
+        # every function or class using the condition samples it with a
+        # sampler of its own
+        self.rate = parsed.get("sample")
+        self.budget = parsed.get("budget")
+        # checked in the background, see deferred.py
+        self.deferred = parsed.get("defer", False)
+        # conditions used as invariants are compiled into a function of self
+        # by _invariant_function()
+        self.function = None
+
+    def __getattr__(self, name):
+        # only called for the slots not set yet
+        if name not in ("tree", "olds", "uses_old", "old_args", "self_attrs"):
+            raise AttributeError(name)
+        self._parse()
+        return getattr(self, name)
+
+    def _parse(self):
+        # parse with compile() rather than ast.parse(), so the conditions
+        # keep seeing print as a function like they did when they were
+        # compiled directly from this module
+        tree = compile(self.text, "<dbc>", "eval", ast.PyCF_ONLY_AST)
+        transformer = _OldTransformer()
+        tree = transformer.visit(tree)
+        uses_old = any(isinstance(node, ast.Name) and node.id == "__old__"
+                       for node in ast.walk(tree))
+        self.olds = tuple(transformer.olds)
+        self.uses_old = uses_old
+        self.old_args = _old_arguments(tree) if uses_old else frozenset()
+        self.self_attrs = _self_attributes(tree)
+        self.tree = tree.body
+
+
+# compiled conditions, keyed by their source text and options; every
+# distinct condition is compiled only once, no matter how many functions,
+# classes or instances it is attached to
+_conditions = {}
+
+
+# guards everything shared that is not only read while checking: the
+# memos, the contract tables and the list of per-thread counters
+_lock = threading.RLock()
+
+
+def _condition(text, options=""):
+    try:
+        return _conditions[text, options]
+    except KeyError:
+        with _lock:
+            cond = _conditions.get((text, options))
+            if cond is None:
+                cond = _conditions[text, options] = _Condition(text, options)
+            return cond
+
+
+####
+# state of each thread: every thread counts into counters of its own, which
+# are only added up when they are read, and has its own transactions
+
+# the counters of all running threads, after those of all threads that
+# have ended, which are added up into the first
+_thread_counts = [collections.defaultdict(int)]
+
+
+class _Retire(object):
+    # dropped together with the state of its thread when the thread ends
+    __slots__ = ("counts",)
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    def __del__(self):
+        try:
+            with _lock:
+                for i, counts in enumerate(_thread_counts):
+                    if counts is self.counts:
+                        del _thread_counts[i]
+                        break
+                for k, v in self.counts.items():
+                    _thread_counts[0][k] += v
+        except (AttributeError, TypeError):
+            # the module is already gone at interpreter shutdown
+            pass
+
+
+class _ThreadState(threading.local):
+    def __init__(self):
+        self.counts = collections.defaultdict(int)
+        self.retire = _Retire(self.counts)
+        # ids of the objects this thread has transactions open on, with
+        # their nesting depth
+        self.suspended = {}
+        with _lock:
+            _thread_counts.append(self.counts)
+
+
+_local = _ThreadState()
+
+
+class _Counters(object):
+    # the keys the counters of one function or class are kept under; they
+    # are dropped from the counters of every thread together with the
+    # function or class
+    __slots__ = ("checked", "skipped")
+
+    def __init__(self):
+        self.checked = ("checked", object())
+        self.skipped = ("skipped", object())
+
+    def __del__(self):
+        try:
+            with _lock:
+                for counts in _thread_counts:
+                    counts.pop(self.checked, None)
+                    counts.pop(self.skipped, None)
+        except (AttributeError, TypeError):
+            # the module is already gone at interpreter shutdown
+            pass
+
+
+# keys of the counters over all contracts, see statistics()
+_statistics = ("calls_checked", "calls_skipped", "assignments_checked",
+               "assignments_skipped", "conditions_skipped", "postconditions_skipped")
+
+
+def _count(key):
+    with _lock:
+        counts = list(_thread_counts)
+    return sum(c.get(key, 0) for c in counts)
+
+
+def statistics(elem=None):
+    # the global counters, or those of one decorated function or class
+    if elem is None:
+        return dict((k, _count(k)) for k in _statistics)
+    counters = elem.__dbc_statistics__
+    return {"checked": _count(counters.checked), "skipped": _count(counters.skipped)}
+
+
+def reset_statistics(elem=None):
+    if elem is None:
+        keys = _statistics
+    else:
+        keys = (elem.__dbc_statistics__.checked, elem.__dbc_statistics__.skipped)
+    with _lock:
+        for counts in _thread_counts:
+            for k in keys:
+                counts.pop(k, None)
 
 
 class DbcViolation(Exception):
@@ -34,111 +427,1482 @@ class DbcViolation(Exception):
         return "DBC Constraint '%s' violated" % self.con
 
 
-def dbc(elem):
+####
+# enforcement levels: each level checks everything the lower ones check
+OFF = 0     # nothing is checked
+PRE = 1     # preconditions
+POST = 2    # preconditions and postconditions
+FULL = 3    # preconditions, postconditions and invariants
+
+_level_names = {"off": OFF, "pre": PRE, "post": POST, "full": FULL}
+
+
+def _parse_level(level):
+    try:
+        level = _level_names.get(level.strip().lower(), level)
+    except AttributeError:
+        pass
+    try:
+        if OFF <= int(level) <= FULL:
+            return int(level)
+    except (TypeError, ValueError):
+        pass
+    raise ValueError("Invalid dbc level %r, must be one of off, pre, post, full" % (level,))
+
+
+# the level is read from DBC_LEVEL at import time and can be changed at
+# runtime with set_level(); if it is OFF while decorating, dbc returns the
+# function or class untouched
+_level = _parse_level(os.environ.get("DBC_LEVEL", "full"))
+
+
+def set_level(level):
+    global _level
+    _level = _parse_level(level)
+    _set_global("_dbc_level", _level)
+
+
+def get_level():
+    return _level
+
+
+# the fraction of calls and assignments that are checked, unless a function
+# or class sets its own; read from DBC_SAMPLE at import time
+_sample_rate = _parse_rate(os.environ.get("DBC_SAMPLE", "1"))
+
+
+def set_sample_rate(rate):
+    global _sample_rate
+    _sample_rate = _parse_rate(rate)
+    _set_global("_dbc_sample_rate", _sample_rate)
+
+
+def get_sample_rate():
+    return _sample_rate
+
+
+# whether condition evaluations, snapshots and invariant checks are timed
+# and recorded for profile(); read from DBC_PROFILE at import time
+_profiling = os.environ.get("DBC_PROFILE", "0").lower() not in ("", "0", "off", "false", "no")
+
+
+def set_profiling(on):
+    global _profiling
+    _profiling = bool(on)
+    _set_global("_dbc_profiling", _profiling)
+
+
+def get_profiling():
+    return _profiling
+
+
+####
+# time budgets: a condition that takes longer than its budget several
+# checks in a row is demoted, to being checked on a tenth of the calls,
+# then a hundredth, a thousandth, and at last not at all
+
+# the budget of the conditions of functions and classes decorated from now
+# on that do not set their own; read from DBC_BUDGET at import time
+_budget = _parse_budget(os.environ["DBC_BUDGET"]) if os.environ.get("DBC_BUDGET") else None
+
+
+def set_budget(budget):
+    global _budget
+    _budget = None if budget is None else _parse_budget(budget)
+
+
+def get_budget():
+    return _budget
+
+
+# how many checks in a row over budget demote a condition, and how often
+# it can be demoted before it is disabled
+_budget_strikes = 3
+_budget_demotions = 4
+
+_log = logging.getLogger("dbc")
+
+# every demotion so far, see demotions()
+_demotions = []
+
+
+def demotions():
+    return [dict(d) for d in _demotions]
+
+
+def reset_demotions():
+    del _demotions[:]
+
+
+class _Budget(object):
+    # the budget of one condition in one function or class
+    __slots__ = ("owner", "cond", "limit", "relative", "rate", "sampler", "strikes",
+                 "demotions", "spent")
+
+    def __init__(self, owner, cond, budget):
+        self.owner = owner
+        self.cond = cond
+        self.limit, self.relative = budget
+        self.rate = 1.0
+        self.sampler = _Sampler(1.0)
+        self.strikes = 0
+        self.demotions = 0
+        # time spent on the condition during the current call
+        self.spent = 0.0
+
+    def charge(self, spent, duration):
+        limit = self.limit * duration if self.relative else self.limit
+        if spent <= limit:
+            self.strikes = 0
+            return
+        self.strikes += 1
+        if self.strikes >= _budget_strikes and self.rate > 0.0:
+            self.strikes = 0
+            self.demotions += 1
+            self.rate = 10.0 ** -self.demotions if self.demotions < _budget_demotions else 0.0
+            _demotions.append({"owner": self.owner, "condition": self.cond.text,
+                               "rate": self.rate, "spent": spent, "limit": limit})
+            _log.warning("%s: condition '%s' took %.3g s, over its budget of %.3g s; %s",
+                         self.owner, self.cond.text, spent, limit,
+                         "checking it on %g of the calls" % self.rate if self.rate else "disabled it")
+
+
+def _judge(budgets, duration):
+    # charge the conditions checked during a call of the given duration
+    for b in budgets:
+        if b.spent:
+            spent, b.spent = b.spent, 0.0
+            b.charge(spent, duration)
+
+
+def dbc(elem=None, sample=None, budget=None, report=None, memo=None, invariants=None):
+    # used as @dbc or with options as @dbc(sample=0.1)
+    if elem is None:
+        return lambda elem: dbc(elem, sample, budget, report, memo, invariants)
+    if sample is not None:
+        sample = _parse_rate(sample)
+    if budget is not None:
+        budget = _parse_budget(budget)
+    if memo is not None and (isinstance(memo, bool) or int(memo) < 1):
+        raise ValueError("Memo size must be a positive number, not %r" % (memo,))
+    if invariants not in (None, "assignments", "methods"):
+        raise ValueError("Invariants are checked on 'assignments' or 'methods', not %r" % (invariants,))
+
+    if isinstance(elem, (staticmethod, classmethod)):
+        # @dbc above @staticmethod or @classmethod decorates the function
+        return type(elem)(dbc(elem.__func__, sample, budget, report, memo, invariants))
+    if _level == OFF:
+        if not (inspect.isclass(elem) or inspect.ismethod(elem) or inspect.isfunction(elem)):
+            raise AttributeError("Argument must be a class, method or function!")
+        return elem
     if inspect.isclass(elem):
-        return _dbc_class(elem)
+        if memo is not None:
+            raise AttributeError("Only functions and methods can memoise their preconditions")
+        return _dbc_class(elem, sample, budget, report, invariants == "methods")
+    elif invariants is not None:
+        raise AttributeError("Only classes have invariants")
     elif inspect.ismethod(elem):
-        return _dbc_function(elem)
+        return _dbc_function(elem, sample=sample, budget=budget, report=report, memo=memo)
     elif inspect.isfunction(elem):
-        return _dbc_function(elem)
+        return _dbc_function(elem, sample=sample, budget=budget, report=report, memo=memo)
     else:
         raise AttributeError("Argument must be a class, method or function!")
 
 
-def _dbc_function(func, self=None, additional=None):
-    if additional is None:
-        additional = []
+def _getargspec(func):
+    # (names, varargs, varkw, defaults, kwonly, kwonlydefaults); the
+    # signature of transactional methods is taken from the method they wrap,
+    # other decorators may change it
+    while getattr(func, "__dbc_transaction__", False):
+        func = func.__wrapped__
+    if hasattr(inspect, "getfullargspec"):
+        spec = inspect.getfullargspec(func)
+        return (spec.args, spec.varargs, spec.varkw, spec.defaults or (),
+                spec.kwonlyargs, spec.kwonlydefaults or {})
+    spec = inspect.getargspec(func)
+    return spec.args, spec.varargs, spec.keywords, spec.defaults or (), [], {}
+
+
+####
+# report mode: violations are recorded (see report.py) rather than raised;
+# switched on for everything with set_report() or DBC_REPORT, or for single
+# functions and classes with @dbc(report=True)
+_reporting = os.environ.get("DBC_REPORT", "0").lower() not in ("", "0", "off", "false", "no")
+
+
+def set_report(on=True, size=1000, capture=10, handler=None, handler_rate=1.0):
+    # keeps the last size violations, the values of the first capture ones
+    # of every condition, and calls handler at most handler_rate times a
+    # second
+    global _reporting
+    _report.configure(size, capture, handler, handler_rate)
+    _reporting = bool(on)
+
+
+def get_report():
+    return _reporting
+
 
+def _fail(cond, values=None):
+    if _reporting:
+        _report.record(cond.text, values)
+    else:
+        raise DbcViolation(cond.text)
+
+
+def _record_fail(cond, values=None):
+    _report.record(cond.text, values)
+
+
+def _raise_fail(cond, values=None):
+    raise DbcViolation(cond.text)
+
+
+# how violations are handled, by the report option of a function or class
+_fails = {None: _fail, True: _record_fail, False: _raise_fail}
+
+
+####
+# memoised preconditions: with @dbc(memo=size), the arguments preconditions
+# passed for are remembered, so that they are not checked again for the
+# same arguments; only arguments of immutable builtin types are remembered
+
+_immutable_types = set([int, float, complex, bool, str, bytes, type(None)])
+_immutable_types.update(t for t in (getattr(_builtins, "long", None),
+                                    getattr(_builtins, "unicode", None)) if t)
+
+
+def _memo_key(values):
+    # values with their types, so that e.g. 1 and 1.0 are told apart, or
+    # None if any of them might change; floats and complex numbers by their
+    # repr, as e.g. 0.0 and -0.0 are equal but not the same
+    key = []
+    for v in values:
+        t = type(v)
+        if t is float or t is complex:
+            key.append((t, repr(v)))
+        elif t in _immutable_types:
+            key.append((t, v))
+        elif t is tuple or t is frozenset:
+            k = _memo_key(v)
+            if k is None:
+                return None
+            key.append((t, k if t is tuple else frozenset(k)))
+        else:
+            return None
+    return tuple(key)
+
+
+class _Memo(object):
+    # a least recently used cache of argument keys
+    __slots__ = ("maxsize", "keys", "lock", "hits", "misses", "uncacheable")
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.keys = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.uncacheable = 0
+
+    def lookup(self, key):
+        if key is None:
+            self.uncacheable += 1
+            return False
+        with self.lock:
+            if key in self.keys:
+                self.hits += 1
+                del self.keys[key]
+                self.keys[key] = True
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        if key is None:
+            return
+        with self.lock:
+            self.keys[key] = True
+            if len(self.keys) > self.maxsize:
+                self.keys.popitem(last=False)
+
+
+def memo_info(func):
+    memo = func.__dbc_memo__
+    return {"hits": memo.hits, "misses": memo.misses, "uncacheable": memo.uncacheable,
+            "size": len(memo.keys), "maxsize": memo.maxsize}
+
+
+def clear_memo(func):
+    memo = func.__dbc_memo__
+    with memo.lock:
+        memo.keys.clear()
+        memo.hits = memo.misses = memo.uncacheable = 0
+
+
+####
+# code generation: every decorated function gets a wrapper of its own with
+# the same signature, in which the conditions are inlined as expressions
+# over its parameters
+
+# the globals of all generated wrappers; besides the parameters, the
+# builtins and the predicates, conditions can see these names
+_namespace = {
+    "_dbc_level": _level,
+    "_dbc_sample_rate": _sample_rate,
+    "_dbc_local": _local,
+    "_dbc_fail": _fail,
+    "_dbc_snapshot": snapshot,
+    "_dbc_NO_SNAPSHOT": NO_SNAPSHOT,
+    "_dbc_profiling": _profiling,
+    "_dbc_clock": _profiler.clock,
+    "_dbc_record": _profiler.record_condition,
+    "_dbc_record_snapshot": _profiler.record_snapshot,
+    "_dbc_judge": _judge,
+    "_dbc_defer": _deferred.defer,
+    "_dbc_memo_key": _memo_key,
+    "_dbc_DbcViolation": DbcViolation,
+}
+_namespace.update(_predicates)
+
+
+class _Placeholders(ast.NodeTransformer):
+    # replaces the placeholder names in the generated code by the ASTs of
+    # the conditions and old(...) expressions
+    def __init__(self, exprs):
+        self.exprs = exprs
+
+    def visit_Name(self, node):
+        expr = self.exprs.get(node.id)
+        if expr is None:
+            return node
+        expr = copy.deepcopy(expr)
+        for child in ast.walk(expr):
+            for attr in ("lineno", "col_offset", "end_lineno", "end_col_offset"):
+                if hasattr(node, attr):
+                    setattr(child, attr, getattr(node, attr))
+        return expr
+
+
+class _WrapperBuilder(object):
+    def __init__(self):
+        self.lines = []
+        self.closure = {}
+        # how to get every value of the closure again, see _recipe_values()
+        self.recipe = {}
+        self.exprs = {}
+        # the samplers of the conditions with a rate of their own
+        self.samplers = {}
+        # added to the depth of every line
+        self.indent = 0
+
+    def emit(self, depth, line):
+        self.lines.append("    " * (depth + self.indent) + line)
+
+    def value(self, prefix, value, ref):
+        # a name under which the generated code sees value; ref describes
+        # it for the cache, as a tuple of strings and numbers
+        name = "_dbc_%s%d" % (prefix, len(self.closure))
+        self.closure[name] = value
+        self.recipe[name] = ref
+        return name
+
+    def expr(self, node):
+        name = "_dbc_expr%d" % len(self.exprs)
+        self.exprs[name] = node
+        return name
+
+    def check(self, depth, cond, skip=None, owner=None, budget=None, tree=None):
+        # an if/elif chain: skipped because a snapshot it depends on is
+        # missing, skipped by sampling, or violated; if an owner is given,
+        # the evaluation is timed and recorded for it, if a budget is given,
+        # it is timed and charged to it; tree replaces that of the condition
+        c = self.value("cond", cond, ("cond", cond.text, cond.options))
+        tree = cond.tree if tree is None else tree
+        keyword = "if"
+        if skip:
+            self.emit(depth, "if %s:" % skip)
+            self.emit(depth + 1, '_dbc_c["postconditions_skipped"] += 1')
+            keyword = "elif"
+        if cond in self.samplers:
+            sampler = self.value("sampler", self.samplers[cond], ("sampler", cond.text, cond.options))
+            self.emit(depth, "%s not %s.sample(%s.rate):" % (keyword, sampler, sampler))
+            self.emit(depth + 1, '_dbc_c["conditions_skipped"] += 1')
+            keyword = "elif"
+        if budget is not None:
+            budget = self.value("budget", budget, ("budget", cond.text, cond.options))
+            self.emit(depth, "%s %s.rate < 1.0 and not %s.sampler.sample(%s.rate):" % (
+                keyword, budget, budget, budget))
+            self.emit(depth + 1, '_dbc_c["conditions_skipped"] += 1')
+            keyword = "elif"
+        elif owner is None:
+            self.emit(depth, "%s not (%s):" % (keyword, self.expr(tree)))
+            self.emit(depth + 1, "_dbc_fail(%s, locals())" % c)
+            return
+        if keyword != "if":
+            self.emit(depth, "else:")
+            depth += 1
+        self.emit(depth, "_dbc_t = _dbc_clock()")
+        self.emit(depth, "_dbc_ok = %s" % self.expr(tree))
+        self.emit(depth, "_dbc_t = _dbc_clock() - _dbc_t")
+        if owner is not None:
+            self.emit(depth, "_dbc_record(%s, %s, _dbc_t)" % (owner, c))
+        if budget is not None:
+            self.emit(depth, "%s.spent += _dbc_t" % budget)
+        self.emit(depth, "if not _dbc_ok:")
+        self.emit(depth + 1, "_dbc_fail(%s, locals())" % c)
+
+    def defer(self, depth, cond, skip, check, args):
+        # like check(), but only queues the check for a worker thread
+        keyword = "if"
+        if skip:
+            self.emit(depth, "if %s:" % skip)
+            self.emit(depth + 1, '_dbc_c["postconditions_skipped"] += 1')
+            keyword = "elif"
+        if cond in self.samplers:
+            sampler = self.value("sampler", self.samplers[cond], ("sampler", cond.text, cond.options))
+            self.emit(depth, "%s not %s.sample(%s.rate):" % (keyword, sampler, sampler))
+            self.emit(depth + 1, '_dbc_c["conditions_skipped"] += 1')
+            keyword = "elif"
+        if keyword != "if":
+            self.emit(depth, "else:")
+            depth += 1
+        # the check runs after the call, so it gets snapshots of the
+        # arguments and __ret__, taken now; a condition on a value too
+        # large to snapshot is skipped, like one on a missing old value
+        values = [a if a.startswith("__old") else "_dbc_snapshot(%s)" % a for a in args]
+        taken = [i for i, a in enumerate(args) if not a.startswith("__old")]
+        self.emit(depth, "_dbc_v = (%s)" % "".join(v + ", " for v in values))
+        if taken:
+            self.emit(depth, "if %s:" % " or ".join("_dbc_v[%d] is _dbc_NO_SNAPSHOT" % i for i in taken))
+            self.emit(depth + 1, '_dbc_c["postconditions_skipped"] += 1')
+            self.emit(depth, "else:")
+            depth += 1
+        self.emit(depth, "_dbc_defer(%s, _dbc_v)" % check)
+
+    def build(self, namespace, key):
+        # compiles the generated functions, stores them in the cache under
+        # key and defines them in namespace
+        source = "\n".join(self.lines) + "\n"
+        tree = compile(source, "<dbc>", "exec", ast.PyCF_ONLY_AST)
+        tree = ast.fix_missing_locations(_Placeholders(self.exprs).visit(tree))
+        code = compile(tree, "<dbc>", "exec")
+        _cache.store(key, code, self.recipe)
+        return _define(code, self.closure, namespace)
+
+
+def _define(code, closure, namespace):
+    # namespace gets the globals all generated code shares and the values
+    # of the closure
+    namespace.update(_namespace)
+    namespace.update(closure)
+    exec(code, namespace)
+    return namespace["dbc_wrapper"]
+
+
+# every function whose wrapper has been generated: each has globals of its
+# own, which have to follow changes to the shared ones
+_prepared = weakref.WeakSet()
+
+
+def _set_global(name, value):
+    with _lock:
+        _namespace[name] = value
+        for f in list(_prepared):
+            f.__globals__[name] = value
+
+
+def _invariant_function(cond):
+    key = _cache.key(["invariant", cond.text])
+    entry = _cache.load(key)
+    if entry is not None:
+        return _define(entry[0], {}, {})
+    b = _WrapperBuilder()
+    b.emit(0, "def dbc_wrapper(self):")
+    b.emit(1, "return %s" % b.expr(_optimize.fold(cond.tree)))
+    return b.build({}, key)
+
+
+def _generate_wrapper(func, bound, pres, posts, yields, depends, olds, old_args,
+                      additional, boundary, sample, sampler, counters, budgets, samplers, memo,
+                      namespace, key):
+    names, varargs, varkw, defaults, kwonly, kwonlydefaults = _getargspec(func)
+    b = _WrapperBuilder()
+    b.samplers = samplers
+
+    # the signature of the wrapper, and how it calls the wrapped function;
+    # the profiling variant takes the arguments exactly as they are passed
+    # on to the wrapped function
+    params = []
+    forward = list(names)
+    first_default = len(names) - len(defaults)
+    for i, name in enumerate(names):
+        if bound is not None and i == 0:
+            continue
+        if i >= first_default:
+            name = "%s=%s" % (name, b.value("default", defaults[i - first_default],
+                                            ("default", i - first_default)))
+        params.append(name)
+    if varargs:
+        params.append("*" + varargs)
+        forward.append("*" + varargs)
+    elif kwonly:
+        params.append("*")
+    profiled_params = list(forward) + (["*"] if kwonly and not varargs else [])
+    for name in kwonly:
+        if name in kwonlydefaults:
+            params.append("%s=%s" % (name, b.value("default", kwonlydefaults[name],
+                                                   ("kwdefault", name))))
+        else:
+            params.append(name)
+        profiled_params.append(name)
+        forward.append("%s=%s" % (name, name))
+    if varkw:
+        params.append("**" + varkw)
+        profiled_params.append("**" + varkw)
+        forward.append("**" + varkw)
+    for name in profiled_params:
+        if name.lstrip("*").startswith("_dbc_"):
+            raise AttributeError("Parameter names starting with _dbc_ are reserved")
+    forward = ", ".join(forward)
+    # coroutine functions get coroutine wrappers, which check the
+    # postconditions once the result has been awaited
+    coroutine = getattr(inspect, "iscoroutinefunction", lambda f: False)(func)
+    define, wait = ("async def", "await ") if coroutine else ("def", "")
+    # whether results may be asynchronous iterators, which only Pythons
+    # with async generators can iterate in generated code
+    asynchronous = hasattr(inspect, "isasyncgenfunction")
+    call = "%s%s(%s)" % (wait, b.value("func", func, ("func",)), forward)
+    counters = b.value("counters", counters, ("counters",))
+    sampler = b.value("sampler", sampler, ("call_sampler",))
+    owner = b.value("owner", _profiler.owner_name(func), ("owner",))
+    judge = b.value("budgets", tuple(budgets.values()), ("budgets",)) if budgets else None
+
+    def checked_call(depth):
+        # calls with budgeted conditions are timed, so that the conditions
+        # can be charged relative to them
+        if judge is None:
+            b.emit(depth, "return %s" % call)
+            return
+        b.emit(depth, "_dbc_t0 = _dbc_clock()")
+        b.emit(depth, "__ret__ = %s" % call)
+        b.emit(depth, "_dbc_judge(%s, _dbc_clock() - _dbc_t0)" % judge)
+        b.emit(depth, "return __ret__")
+
+    def body(profiled):
+        checks(profiled)
+        if additional and boundary:
+            b.indent -= 1
+            b.emit(1, "finally:")
+            b.emit(2, "if _dbc_s:")
+            # counted like transactions, which other calls on the same
+            # thread, e.g. other tasks, may open and close meanwhile
+            b.emit(3, "_dbc_u = _dbc_local.suspended")
+            b.emit(3, "_dbc_u[id(%s)] -= 1" % names[0])
+            b.emit(3, "if not _dbc_u[id(%s)]:" % names[0])
+            b.emit(4, "del _dbc_u[id(%s)]" % names[0])
+
+    def checks(profiled):
+        if not profiled:
+            if bound is not None:
+                b.emit(1, "%s = %s" % (names[0], b.value("bound", bound, ("bound",))))
+            b.emit(1, "_dbc_l = _dbc_level")
+            b.emit(1, "if not _dbc_l:")
+            b.emit(2, "return %s" % call)
+            b.emit(1, "if _dbc_profiling:")
+            b.emit(2, "return %s_dbc_profiled(%s)" % (wait, forward))
+        else:
+            b.emit(1, "_dbc_l = _dbc_level")
+        timed = owner if profiled else None
+
+        b.emit(1, "_dbc_c = _dbc_local.counts")
+        if sample is None or sample < 1.0:
+            rate = "_dbc_sample_rate" if sample is None else repr(sample)
+            b.emit(1, "if %s < 1.0 and not %s.sample(%s):" % (rate, sampler, rate))
+            b.emit(2, "_dbc_c[%s.skipped] += 1" % counters)
+            b.emit(2, '_dbc_c["calls_skipped"] += 1')
+            b.emit(2, "return %s" % call)
+        b.emit(1, "_dbc_c[%s.checked] += 1" % counters)
+        b.emit(1, '_dbc_c["calls_checked"] += 1')
+
+        # soft invariants come first, are only checked at level FULL and
+        # are deferred while the object is in a transaction; at method
+        # boundaries, the object is in one until the call has been checked,
+        # so that the calls it makes on itself are not checked
+        n = len(additional)
+        if n:
+            b.emit(1, "if _dbc_l == 3 and id(%s) in _dbc_local.suspended:" % names[0])
+            b.emit(2, "_dbc_l = 2")
+            if boundary:
+                b.emit(1, "_dbc_s = _dbc_l == 3")
+                b.emit(1, "if _dbc_s:")
+                b.emit(2, "_dbc_u = _dbc_local.suspended")
+                b.emit(2, "_dbc_u[id(%s)] = _dbc_u.get(id(%s), 0) + 1" % (names[0], names[0]))
+                b.emit(1, "try:")
+                b.indent += 1
+            b.emit(1, "if _dbc_l == 3:")
+            for cond in pres[:n]:
+                b.check(2, cond, owner=timed, budget=budgets.get(cond))
+        checked = pres[n:]
+        if memo is not None and not profiled:
+            # preconditions that only read arguments, checked together and
+            # remembered as passed for their arguments
+            pure = [cond for cond in checked if cond.rate is None and cond not in budgets and
+                    not reads(cond, ("self", names[0] if bound is not None else "self"))]
+            if pure:
+                used = sorted(set(k for cond in pure for k in fa if reads(cond, (k,))))
+                m = b.value("memo", memo, ("memo",))
+                b.emit(1, "_dbc_k = _dbc_memo_key((%s))" % "".join(k + ", " for k in used))
+                b.emit(1, "if not %s.lookup(_dbc_k):" % m)
+                b.emit(2, "if %s:" % " and ".join("(%s)" % b.expr(_optimize.fold(cond.tree))
+                                                  for cond in pure))
+                b.emit(3, "%s.add(_dbc_k)" % m)
+                b.emit(2, "else:")
+                for cond in pure:
+                    b.check(3, cond)
+                checked = [cond for cond in checked if cond not in pure]
+        if profiled:
+            for cond in checked:
+                b.check(1, cond, owner=timed, budget=budgets.get(cond))
+        else:
+            optimized(1, checked, lambda depth, cond, tree: b.check(
+                depth, cond, budget=budgets.get(cond), tree=tree), "_dbc_pre")
+
+        if not posts and not yields:
+            checked_call(1)
+            return
+
+        b.emit(1, "if _dbc_l == 1:")
+        checked_call(2)
+        if profiled and (old_args or olds):
+            b.emit(1, "_dbc_t = _dbc_clock()")
+        if old_args:
+            b.emit(1, "__old__ = {%s}" % ", ".join("%r: _dbc_snapshot(%s)" % (k, k) for k in old_args))
+        for name, node in olds:
+            b.emit(1, "%s = _dbc_snapshot(%s)" % (name, b.expr(node)))
+        if profiled and (old_args or olds):
+            values = (["__old__"] if old_args else []) + [old[0] for old in olds]
+            b.emit(1, "_dbc_record_snapshot(%s, _dbc_clock() - _dbc_t, (%s,))" % (owner, ", ".join(values)))
+        if judge is None:
+            b.emit(1, "__ret__ = %s" % call)
+        else:
+            b.emit(1, "_dbc_t0 = _dbc_clock()")
+            b.emit(1, "__ret__ = %s" % call)
+            b.emit(1, "_dbc_t0 = _dbc_clock() - _dbc_t0")
+
+        def skip(deps):
+            return " or ".join(("%s is _dbc_NO_SNAPSHOT" if k.startswith("__old") else
+                                "__old__[%r] is _dbc_NO_SNAPSHOT") % k for k in sorted(deps))
+        if n:
+            b.emit(1, "if _dbc_l == 3:")
+            for cond, deps in zip(posts[:n], depends[:n]):
+                b.check(2, cond, skip(deps), timed, budgets.get(cond))
+        checked = []
+        for cond, deps in zip(posts[n:], depends[n:]):
+            if cond in deferred:
+                b.defer(1, cond, skip(deps), *deferred[cond])
+            elif profiled:
+                b.check(1, cond, skip(deps), timed, budgets.get(cond))
+            else:
+                checked.append(cond)
+        if checked:
+            deps = dict(zip(posts, depends))
+            optimized(1, checked, lambda depth, cond, tree: b.check(
+                depth, cond, skip(deps[cond]), budget=budgets.get(cond), tree=tree), "_dbc_post")
+        if yields:
+            # iterators are checked as they are consumed, containers right
+            # away, and results that are not iterable, like None, have no
+            # items to check; asynchronous iterators, e.g. of async
+            # generators, are checked as they are consumed, too
+            b.emit(1, "try:")
+            b.emit(2, "_dbc_it = iter(__ret__)")
+            b.emit(1, "except TypeError:")
+            if asynchronous:
+                b.emit(2, 'if hasattr(__ret__, "__aiter__"):')
+                b.emit(3, "__ret__ = _dbc_aitems(__ret__, %s)" % forward)
+            else:
+                b.emit(2, "pass")
+            b.emit(1, "else:")
+            b.emit(2, "if _dbc_it is __ret__:")
+            b.emit(3, "__ret__ = _dbc_items(__ret__, %s)" % forward)
+            b.emit(2, "else:")
+            b.emit(3, "for _dbc_item in _dbc_items(_dbc_it, %s):" % forward)
+            b.emit(4, "pass")
+        if judge is not None:
+            b.emit(1, "_dbc_judge(%s, _dbc_t0)" % judge)
+        b.emit(1, "return __ret__")
+
+    fa = list(names) + list(kwonly) + [k for k in (varargs, varkw) if k]
+
+    def reads(cond, known):
+        return any(isinstance(node, ast.Name) and node.id in known for node in ast.walk(cond.tree))
+
+    def optimized(depth, conds, check, prefix):
+        # checks conds folded, cheapest first and sharing the calls they
+        # have in common; if that raises anything but a violation, e.g.
+        # because a condition relied on an earlier one to rule out values
+        # it cannot handle, those not done yet are checked again as
+        # written, so that none is reported twice
+        plain = [cond.rate is None and cond not in budgets for cond in conds]
+        private = set(["__old__"] + [old[0] for old in olds])
+        order, hoists, trees = _optimize.optimize([cond.tree for cond in conds], plain, set(fa),
+                                                  private, prefix)
+        fallback = bool(hoists) or order != sorted(order)
+        inner = depth + 1 if fallback else depth
+        if fallback:
+            # the position of the condition being checked
+            b.emit(depth, "_dbc_p = 0")
+            b.emit(depth, "try:")
+        emitted = len(b.lines)
+        for pos, i in enumerate(order):
+            if fallback and pos and (hoists.get(pos) or trees[pos] is not None):
+                b.emit(inner, "_dbc_p = %d" % pos)
+            for name, node in hoists.get(pos, ()):
+                b.emit(inner, "%s = %s" % (name, b.expr(node)))
+            if trees[pos] is not None:
+                check(inner, conds[i], trees[pos])
+        if fallback:
+            if len(b.lines) == emitted:
+                b.emit(inner, "pass")
+            b.emit(depth, "except _dbc_DbcViolation:")
+            b.emit(depth + 1, "raise")
+            b.emit(depth, "except Exception:")
+            for i, cond in enumerate(conds):
+                b.emit(depth + 1, "if _dbc_p <= %d:" % order.index(i))
+                check(depth + 2, cond, None)
+
+    # deferred postconditions are checked by functions of the names they
+    # use, which run in a worker thread
+    deferred = {}
+    for cond in posts:
+        if cond.deferred and cond not in deferred:
+            known = set(fa + [old[0] for old in olds] + ["__ret__", "__old__"])
+            args = sorted(set(node.id for node in ast.walk(cond.tree)
+                              if isinstance(node, ast.Name) and node.id in known))
+            check = "_dbc_deferred%d" % len(deferred)
+            deferred[cond] = check, args
+            b.emit(0, "def %s(%s):" % (check, ", ".join(args)))
+            b.emit(1, "if not (%s):" % b.expr(cond.tree))
+            b.emit(2, "_dbc_fail(%s, locals())" % b.value("cond", cond, ("cond", cond.text, cond.options)))
+
+    if yields:
+        # a generator passing on the items of the result, checking the
+        # yield conditions on each of them; conditions on __prev__ start
+        # with the second item
+        for name, prefix in (("_dbc_items", ""), ("_dbc_aitems", "async ")):
+            if prefix and not asynchronous:
+                continue
+            b.emit(0, "%sdef %s(_dbc_it, %s):" % (prefix, name, ", ".join(profiled_params)))
+            b.emit(1, "__index__ = 0")
+            b.emit(1, "%sfor __item__ in _dbc_it:" % prefix)
+            if any(cond.rate is not None for cond in yields):
+                b.emit(2, "_dbc_c = _dbc_local.counts")
+            for cond in yields:
+                if any(isinstance(node, ast.Name) and node.id == "__prev__" for node in ast.walk(cond.tree)):
+                    b.emit(2, "if __index__:")
+                    b.check(3, cond)
+                else:
+                    b.check(2, cond)
+            b.emit(2, "yield __item__")
+            b.emit(2, "__prev__ = __item__")
+            b.emit(2, "__index__ += 1")
+    b.emit(0, "%s _dbc_profiled(%s):" % (define, ", ".join(profiled_params)))
+    body(True)
+    b.emit(0, "%s dbc_wrapper(%s):" % (define, ", ".join(params)))
+    body(False)
+    return b.build(namespace, key)
+
+
+####
+# decorating a function only puts a stub in its place; its conditions are
+# parsed and its wrapper generated on its first call (or by prepare_all()),
+# when the stub takes over the code of the wrapper
+
+def _compile_stub(source):
+    return compile(source, "<dbc>", "exec").co_consts[0]
+
+
+_stub_code = _compile_stub("def dbc_wrapper(*args, **kwargs):\n"
+                           "    return _dbc_prepare()(*args, **kwargs)\n")
+_async_stub_code = None
+
+# stubs not called yet
+_pending = weakref.WeakSet()
+
+
+def _dbc_function(func, additional=(), sample=None, budget=None, report=None, memo=None,
+                  boundary=False):
+    global _async_stub_code
     # we need this to work around a difference between methods and
-    # functions: for functions we can store the attribute in
-    # themselves, for methods we need to use their __func__ member
-    # for this
+    # functions: for methods, the conditions are taken from their
+    # __func__ member, and the instance a method is bound to has to be
+    # passed on explicitly
+    target = func
+    bound = getattr(func, "__self__", None)
     if hasattr(func, "__func__"):
         func = func.__func__
 
+    code = _stub_code
+    if getattr(inspect, "iscoroutinefunction", lambda f: False)(func):
+        if _async_stub_code is None:
+            _async_stub_code = _compile_stub("async def dbc_wrapper(*args, **kwargs):\n"
+                                             "    return await _dbc_prepare()(*args, **kwargs)\n")
+        code = _async_stub_code
+    # the builtins of a function are fixed when it is created
+    namespace = {"__builtins__": _builtins}
+    stub = wraps(target)(types.FunctionType(code, namespace, "dbc_wrapper"))
+    # a weak reference, so that stubs never called can be collected
+    ref = weakref.ref(stub)
+    namespace["_dbc_prepare"] = lambda: _prepare(ref())
+
+    stub.__dbc_func__ = func
+    stub.__dbc_additional__ = tuple(additional)
+    stub.__dbc_boundary__ = boundary
+    stub.__dbc_sample__ = sample
+    stub.__dbc_budget__ = budget
+    stub.__dbc_report__ = report
+    stub.__dbc_memo__ = None if memo is None else _Memo(int(memo))
+    stub.__dbc_statistics__ = _Counters()
+    # the default budget is the one set when the function is decorated
+    stub.__dbc_pending__ = (bound, _budget if budget is None else budget)
+    _pending.add(stub)
+    return stub
+
+
+def _prepare(stub):
+    with _lock:
+        if "__dbc_pending__" in stub.__dict__:
+            _prepare_function(stub)
+            del stub.__dbc_pending__
+            _pending.discard(stub)
+            _prepared.add(stub)
+    return stub
+
+
+def _wrapper_key(func, additional, bound, budget, sample, boundary, memo):
+    # what the code of a wrapper depends on, before anything is parsed
+    names, varargs, varkw, defaults, kwonly, kwonlydefaults = _getargspec(func)
+    signature = (names, varargs, varkw, len(defaults), kwonly, sorted(kwonlydefaults))
+    options = (bound is not None, budget, sample, boundary, memo is not None,
+               getattr(inspect, "iscoroutinefunction", lambda f: False)(func))
+    return _cache.key(["function", func.__doc__ or "", repr(signature), repr(options),
+                       repr([(cond.text, cond.options) for cond in additional])])
+
+
+def _recipe_values(recipe, func, conds, samplers, budgets, values):
+    # the closure of a cached wrapper; values has what its refs without
+    # arguments stand for
+    names, varargs, varkw, defaults, kwonly, kwonlydefaults = _getargspec(func)
+    closure = {}
+    for name, ref in recipe.items():
+        kind = ref[0]
+        if kind == "cond":
+            closure[name] = conds[ref[1], ref[2]]
+        elif kind == "sampler":
+            closure[name] = samplers[conds[ref[1], ref[2]]]
+        elif kind == "budget":
+            closure[name] = budgets[conds[ref[1], ref[2]]]
+        elif kind == "default":
+            closure[name] = defaults[ref[1]]
+        elif kind == "kwdefault":
+            closure[name] = kwonlydefaults[ref[1]]
+        else:
+            closure[name] = values[kind]
+    return closure
+
+
+def _prepare_function(stub):
+    func = stub.__dbc_func__
+    additional = stub.__dbc_additional__
+    sample = stub.__dbc_sample__
+    bound, budget = stub.__dbc_pending__
     name = func.__name__
 
-    func.__pres__ = copy.copy(additional)
-    func.__posts__ = copy.copy(additional)
-    if func.func_doc:
-        for line in __getLinesStartingWith("pre:", func.func_doc):
-            if name == "__init__":
-                raise AttributeError("__init__ must not have preconditions or postconditions")
-            func.__pres__.append(line)
-        for line in __getLinesStartingWith("post:", func.func_doc):
-            if name == "__init__":
+    # a wrapper from the cache was generated from the same docstring,
+    # signature and options, so its conditions have been checked already
+    # and need not even be parsed
+    key = _wrapper_key(func, additional, bound, budget, sample, stub.__dbc_boundary__,
+                       stub.__dbc_memo__)
+    entry = _cache.load(key)
+    cached = entry is not None
+
+    pres = list(additional)
+    posts = list(additional)
+    if func.__doc__:
+        for line, options in __getConditionLines("pre", func.__doc__):
+            cond = _condition(line, options)
+            if not cached:
+                if name == "__init__":
+                    raise AttributeError("__init__ must not have preconditions or postconditions")
+                if cond.olds:
+                    raise AttributeError("old(...) may only be used in postconditions")
+                if cond.deferred:
+                    raise AttributeError("Only postconditions can be deferred")
+            pres.append(cond)
+        for line, options in __getConditionLines("post", func.__doc__):
+            if name == "__init__" and not cached:
                 raise AttributeError("__init__ must not have preconditions or postconditions")
-            func.__posts__.append(line)
-
-    @wraps(func)
-    def dbc_wrapper(*args, **kwargs):
-        def __check(conds, a):
-            for i in conds:
-                # we're working around a limitation of eval here: if a list
-                # comprehension is used in eval(...), the variables referenced
-                # inside need to be global, local variables are not found;
-                # therefore, present all values as globals
-                if not eval(i, a):
-                    raise DbcViolation(i)
-
-        fa = inspect.getargspec(func)[0]
-
-        if fa[0] == "self" and len(args) == len(fa) - 1:
-            args = (self,) + args
-        a = dict(zip(fa, args))
-
-        __check(func.__pres__, a)
-        # try copying deep, if that does not work, copy only the first level
-        old = {}
-        for k, v in a.items():
-            try:
-                old[k] = copy.deepcopy(v)
-            except TypeError:
-                old[k] = copy.copy(v)
-
-        ret = func(*args, **kwargs)
-        a["__ret__"] = ret
-        a["__old__"] = old
-        __check(func.__posts__, a)
-        return ret
-
-    return dbc_wrapper
-
-
-def _dbc_class(cls):
-    ####
-    # define and set the new __setattr__
-    def __setattr__(self, name, value):
-        self.__dict__[name] = value
+            posts.append(_condition(line, options))
+    yields = []
+    if func.__doc__:
+        for line, options in __getConditionLines("yield", func.__doc__):
+            cond = _condition(line, options)
+            if not cached:
+                if cond.olds or cond.uses_old:
+                    raise AttributeError("old(...) and __old__ may not be used in yield conditions")
+                if cond.deferred:
+                    raise AttributeError("Only postconditions can be deferred")
+            yields.append(cond)
+
+    # conditions without a budget of their own get the one of the function;
+    # deferred ones cost the call nothing
+    default = budget
+    budgets = {}
+    for cond in pres + posts:
+        if cond not in budgets and not cond.deferred and (cond.budget or default):
+            budgets[cond] = _Budget(_profiler.owner_name(func), cond, cond.budget or default)
+    samplers = dict((cond, _Sampler(cond.rate)) for cond in pres + posts + yields
+                    if cond.rate is not None)
+    sampler = _Sampler(sample)
+
+    if cached:
+        conds = dict(((cond.text, cond.options), cond) for cond in pres + posts + yields)
+        values = {"func": func, "counters": stub.__dbc_statistics__, "call_sampler": sampler,
+                  "owner": _profiler.owner_name(func),
+                  "budgets": tuple(budgets.values()), "bound": bound, "memo": stub.__dbc_memo__}
+        closure = _recipe_values(entry[1], func, conds, samplers, budgets, values)
+        wrapper = _define(entry[0], closure, stub.__globals__)
+    else:
+        # decide now what has to be remembered before each call: only the
+        # old(...) sub-expressions the postconditions use, and only those
+        # arguments a postcondition looks up in __old__; remember as well
+        # which of these each postcondition depends on, so it can be
+        # skipped if one of them was too large to snapshot
+        names, varargs, varkw, _, kwonly, _ = _getargspec(func)
+        fa = list(names) + list(kwonly) + [k for k in (varargs, varkw) if k]
+        olds = []
+        old_args = set()
+        depends = []
+        for cond in posts:
+            olds.extend(old for old in cond.olds if old not in olds)
+            args = fa if cond.old_args is None else cond.old_args
+            old_args.update(args)
+            depends.append(frozenset(args).union(old[0] for old in cond.olds))
+        old_args = [k for k in fa if k in old_args]
+
+        wrapper = _generate_wrapper(func, bound, pres, posts, yields, depends, olds, old_args,
+                                    additional, stub.__dbc_boundary__, sample, sampler,
+                                    stub.__dbc_statistics__, budgets, samplers, stub.__dbc_memo__,
+                                    stub.__globals__, key)
+    if stub.__dbc_report__ is not None:
+        stub.__globals__["_dbc_fail"] = _fails[stub.__dbc_report__]
+    # the code goes last: a call from another thread in between must not
+    # see the new code with the defaults of the stub
+    stub.__defaults__ = wrapper.__defaults__
+    if hasattr(wrapper, "__kwdefaults__"):
+        stub.__kwdefaults__ = wrapper.__kwdefaults__
+    stub.__code__ = wrapper.__code__
+    stub.__pres__ = pres
+    stub.__posts__ = posts
+    stub.__yields__ = yields
+
+
+def _has_conditions(func, kinds=("pre", "post", "yield")):
+    # without parsing them
+    return bool(func.__doc__) and any(
+        any(True for _ in __getConditionLines(kind, func.__doc__)) for kind in kinds)
 
-        if name in ["__invariants__", "__init__", "__init_dbc__"]:
+
+def prepare(elem):
+    # prepare a decorated function or class now rather than on first use
+    if inspect.isclass(elem):
+        _class_table(elem)
+    elif "__dbc_pending__" in getattr(elem, "__dict__", ()):
+        _prepare(elem)
+    return elem
+
+
+def prepare_all():
+    # prepare everything decorated so far: classes first, as building their
+    # contract tables adds more functions.  What fails does not stop the
+    # rest; a single error is raised as it is, several together
+    errors = []
+    with _lock:
+        classes = list(_classes)
+    for cls in classes:
+        try:
+            _class_table(cls)
+        except Exception as e:
+            errors.append((cls, e))
+    with _lock:
+        stubs = list(_pending)
+    for stub in stubs:
+        try:
+            _prepare(stub)
+        except Exception as e:
+            errors.append((stub, e))
+    if len(errors) == 1:
+        raise errors[0][1]
+    if errors:
+        e = AttributeError("%d functions and classes could not be prepared:\n%s" % (
+            len(errors), "\n".join("%s: %s" % (_profiler.owner_name(elem), e) for elem, e in errors)))
+        e.errors = errors
+        raise e
+
+
+def _is_dunder(name):
+    return name.startswith("__") and name.endswith("__")
+
+
+# bumped every time a class is decorated, and stamped on it; a contract
+# table is only rebuilt when the stamps of the class or its bases changed
+# since it was built, the global counter just saves looking at them
+_generation = 0
+
+
+def _stamps(cls):
+    return tuple(c.__dict__.get("__dbc_stamp__") for c in inspect.getmro(cls))
+
+
+def _class_table(cls):
+    if cls.__dict__.get("__dbc_generation__") != _generation:
+        with _lock:
+            if cls.__dict__.get("__dbc_generation__") != _generation:
+                stamps = _stamps(cls)
+                if cls.__dict__.get("__dbc_stamps__") != stamps:
+                    _build_class_table(cls)
+                    cls.__dbc_stamps__ = stamps
+                cls.__dbc_generation__ = _generation
+
+
+def _check_invariants(obj, invariants, name=None):
+    if _level != FULL:
+        return
+    local = _local
+    if local.suspended and id(obj) in local.suspended:
+        return
+    counts = local.counts
+    cls = obj.__class__
+    sample = cls.__dbc_sample__
+    rate = _sample_rate if sample is None else sample
+    if rate < 1.0 and not cls.__dbc_sampler__.sample(rate):
+        counts[cls.__dbc_statistics__.skipped] += 1
+        counts["assignments_skipped"] += 1
+        return
+    counts[cls.__dbc_statistics__.checked] += 1
+    counts["assignments_checked"] += 1
+    budgets = cls.__dbc_budgets__
+    samplers = cls.__dbc_samplers__
+    if _profiling or budgets:
+        _measure_invariants(obj, invariants, name, budgets, samplers, counts)
+        return
+
+    for i in invariants:
+        sampler = samplers.get(i)
+        if sampler is not None and not sampler.sample(sampler.rate):
+            counts["conditions_skipped"] += 1
+            continue
+        # invariants on attributes not yet set (e.g. during __init__) are
+        # not checked
+        try:
+            ok = i.function(obj)
+        except AttributeError:
+            ok = True
+        except Exception:
+            if not _unset(obj, i):
+                raise
+            ok = True
+        if not ok and not _unset(obj, i):
+            _fails[cls.__dbc_report__](i, {"self": obj})
+
+
+def _unset(obj, invariant):
+    # whether an attribute the invariant reads has an _InvariantAttribute
+    # and has not been set on obj yet, so that the invariant read the
+    # descriptor; only asked once an invariant failed
+    values = getattr(obj, "__dict__", {})
+    names = invariant.self_attrs
+    for c in inspect.getmro(obj.__class__):
+        for name, value in vars(c).items():
+            if type(value) is _InvariantAttribute and name not in values and \
+                    (names is None or name in names):
+                return True
+    return False
+
+
+def _measure_invariants(obj, invariants, name, budgets, samplers, counts):
+    # the same as above, but timing every invariant for the profiler or
+    # for its budget
+    owner = _profiler.owner_name(obj.__class__) if _profiling else None
+    if owner is not None and name is not None:
+        _profiler.record_attribute(owner, name)
+    for i in invariants:
+        sampler = samplers.get(i)
+        if sampler is not None and not sampler.sample(sampler.rate):
+            counts["conditions_skipped"] += 1
+            continue
+        budget = budgets.get(i)
+        if budget is not None and budget.rate < 1.0 and not budget.sampler.sample(budget.rate):
+            counts["conditions_skipped"] += 1
+            continue
+        t = _profiler.clock()
+        try:
+            ok = i.function(obj)
+        except AttributeError:
+            ok = True
+        except Exception:
+            if not _unset(obj, i):
+                raise
+            ok = True
+        t = _profiler.clock() - t
+        if owner is not None:
+            _profiler.record_condition(owner, i, t)
+        if budget is not None:
+            budget.charge(t, None)
+        if not ok and not _unset(obj, i):
+            _fails[obj.__class__.__dbc_report__](i, {"self": obj})
+
+
+####
+# transactions: while a thread has a transaction open on an object, that
+# thread does not check its invariants
+
+class _Transaction(object):
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __enter__(self):
+        key = id(self.obj)
+        suspended = _local.suspended
+        suspended[key] = suspended.get(key, 0) + 1
+        return self.obj
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        key = id(self.obj)
+        suspended = _local.suspended
+        suspended[key] -= 1
+        if suspended[key]:
             return
+        del suspended[key]
+        # when the outermost transaction ends successfully, every invariant
+        # is checked once
+        if exc_type is None:
+            cls = self.obj.__class__
+            _check_invariants(self.obj, getattr(cls, "__invariants__", ()) +
+                              getattr(cls, "__dbc_soft_invariants__", ()))
 
-        for i in self.__invariants__:
-            try:
-                if not eval(i):
-                    raise DbcViolation(i)
-            except AttributeError:
-                pass
-    cls.__setattr__ = __setattr__
 
-    ####
-    # define and set the new __init_dbc__
-    def __init_dbc__(self):
-        soft_invariants = []
-        # initialize invariants from all the way up the MRO
-        for c in inspect.getmro(self.__class__):
-            if c.__doc__:
-                for line in __getLinesStartingWith("hinv:", c.__doc__):
-                    self.__invariants__.append(line)
-                for line in __getLinesStartingWith("sinv:", c.__doc__):
-                    soft_invariants.append(line)
-
-        # initialize preconditions and postconditions
-        for name, _ in inspect.getmembers(self, inspect.ismethod):
-            if name != "__setattr__":
-                setattr(self, name, _dbc_function(getattr(self, name), self, soft_invariants))
-    cls.__init_dbc__ = __init_dbc__
+def transaction(obj):
+    # with transaction(obj): defers checking the invariants of obj until the
+    # block ends; used as a method decorator, it does the same for self for
+    # the duration of each call
+    if isinstance(obj, types.FunctionType):
+        if getattr(inspect, "iscoroutinefunction", lambda f: False)(obj):
+            namespace = {"_Transaction": _Transaction, "obj": obj}
+            exec(_async_transactional, namespace)
+            transactional = wraps(obj)(namespace["transactional"])
+        else:
+            @wraps(obj)
+            def transactional(self, *args, **kwargs):
+                with _Transaction(self):
+                    return obj(self, *args, **kwargs)
+        transactional.__wrapped__ = obj
+        transactional.__dbc_transaction__ = True
+        return transactional
+    return _Transaction(obj)
+
+
+# coroutine methods keep their transaction until they are done; compiled at
+# runtime, as Python 2 cannot parse this
+_async_transactional = """
+async def transactional(self, *args, **kwargs):
+    with _Transaction(self):
+        return await obj(self, *args, **kwargs)
+"""
+
+
+_missing = object()
+
+
+class _InvariantAttribute(object):
+    # data descriptor installed for every attribute invariants depend on:
+    # assigning it checks just these invariants, while all other attributes
+    # are assigned without any checks.  Without __get__, reading the
+    # attribute falls through to the instance dict at no cost; only while it
+    # is not set yet, the descriptor itself is read instead of raising
+    # AttributeError (see _unset())
+    __slots__ = ("name", "invariants", "default", "owned")
+
+    def __init__(self, name, invariants, default=_missing, owned=False):
+        self.name = name
+        self.invariants = invariants
+        # a class attribute of the same name this descriptor shadows, and
+        # whether it was defined in the very class the descriptor is in
+        self.default = default
+        self.owned = owned
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+        _check_invariants(obj, self.invariants, self.name)
+
+    def __delete__(self, obj):
+        try:
+            del obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+
+class _DefaultInvariantAttribute(_InvariantAttribute):
+    # the same for an attribute shadowing a class attribute, which is read
+    # while the instance has none of its own
+    __slots__ = ()
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            return self.default
+
+
+class _SlotInvariantAttribute(_InvariantAttribute):
+    # the same for an attribute stored in a slot, whose member descriptor
+    # it shadows
+    __slots__ = ()
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        return self.default.__get__(obj, cls)
+
+    def __set__(self, obj, value):
+        self.default.__set__(obj, value)
+        _check_invariants(obj, self.invariants, self.name)
+
+    def __delete__(self, obj):
+        self.default.__delete__(obj)
+
+
+def _is_slot(value):
+    return isinstance(value, types.MemberDescriptorType)
+
+
+def _make_setattr(base, checks, wildcard, direct):
+    # the fallback if some invariant may depend on any attribute, or if
+    # data descriptors are not available (old-style classes); attributes
+    # in direct are written to the instance dict right away
+    def __setattr__(self, name, value):
+        if base is None or name in direct:
+            self.__dict__[name] = value
+        else:
+            base(self, name, value)
+        _check_invariants(self, checks.get(name, wildcard), name)
+    __setattr__.__dbc_base__ = base
+    return __setattr__
+
+
+def _class_attribute(mro, name):
+    # the attribute as defined in the class, without any descriptor
+    # installed for the invariants
+    for c in mro:
+        value = vars(c).get(name, _missing)
+        if value is not _missing:
+            return value.default if isinstance(value, _InvariantAttribute) else value
+    return _missing
+
+
+def _unconstrain(cls):
+    # remove what an earlier table installed into this class
+    for name, value in list(vars(cls).items()):
+        if isinstance(value, _InvariantAttribute):
+            delattr(cls, name)
+            if value.owned:
+                setattr(cls, name, value.default)
+        elif name == "__setattr__" and hasattr(value, "__dbc_base__"):
+            delattr(cls, name)
+
+
+def _constrain(cls, mro, invariants):
+    # route assignments to the attributes the invariants depend on through
+    # the invariant checks
+    _unconstrain(cls)
+
+    depends = {}
+    wildcard = []
+    for i in invariants:
+        attrs = i.self_attrs
+        if attrs is not None:
+            for name in attrs:
+                # attributes that are computed (properties, methods, ...)
+                # may depend on any other attribute, slots are just storage
+                for c in mro:
+                    value = vars(c).get(name, _missing)
+                    if value is not _missing:
+                        if hasattr(value, "__get__") and not (
+                                isinstance(value, _InvariantAttribute) or _is_slot(value)):
+                            attrs = None
+                        break
+                if attrs is None:
+                    break
+        if attrs is None:
+            wildcard.append(i)
+        else:
+            for name in attrs:
+                depends.setdefault(name, []).append(i)
+    wildcard = tuple(wildcard)
+
+    current = getattr(cls, "__setattr__", None)
+    base = getattr(current, "__dbc_base__", current)
+    base = getattr(base, "__func__", base)
+    if wildcard or not isinstance(cls, type):
+        checks = dict((name, tuple(invs) + wildcard) for name, invs in depends.items())
+        direct = frozenset(name for name in checks if not _is_slot(_class_attribute(mro, name)))
+        cls.__setattr__ = _make_setattr(base, checks, wildcard, direct)
+        return
+
+    if hasattr(current, "__dbc_base__"):
+        cls.__setattr__ = base
+    for name, invs in depends.items():
+        default = _missing
+        owned = False
+        for c in mro:
+            value = vars(c).get(name, _missing)
+            if value is not _missing:
+                if isinstance(value, _InvariantAttribute):
+                    default = value.default
+                else:
+                    default = value
+                    owned = c is cls
+                break
+        if _is_slot(default):
+            kind = _SlotInvariantAttribute
+        elif default is not _missing:
+            kind = _DefaultInvariantAttribute
+        else:
+            kind = _InvariantAttribute
+        setattr(cls, name, kind(name, tuple(invs), default, owned))
+
+
+def _build_class_table(cls):
+    mro = inspect.getmro(cls)
+
+    # collect invariants from all the way up the MRO
+    invariants = []
+    soft_invariants = []
+    for c in mro:
+        if c.__doc__:
+            for line, options in __getConditionLines("hinv", c.__doc__):
+                invariants.append(_condition(line, options))
+            for line, options in __getConditionLines("sinv", c.__doc__):
+                soft_invariants.append(_condition(line, options))
+    soft_invariants = tuple(soft_invariants)
+    for i in invariants + list(soft_invariants):
+        if i.deferred:
+            raise AttributeError("Only postconditions can be deferred")
+        if i.function is None:
+            i.function = _invariant_function(i)
+    sample = getattr(cls, "__dbc_sample__", None)
+    budget = getattr(cls, "__dbc_budget__", None)
+    report = getattr(cls, "__dbc_report__", None)
+    boundary = getattr(cls, "__dbc_boundary__", False)
+
+    # invariants are not checked within a call, so only fixed budgets apply
+    # to them
+    # budgets and samplers of a rebuilt table are kept, with the demotions
+    # and credit they have collected
+    default = _budget if budget is None else budget
+    old_budgets = cls.__dict__.get("__dbc_budgets__", {})
+    budgets = {}
+    for i in invariants:
+        if i.budget is not None and i.budget[1]:
+            raise AttributeError("Invariants can only have fixed budgets")
+        spec = i.budget or (default if default and not default[1] else None)
+        if spec:
+            old = old_budgets.get(i)
+            if old is not None and (old.limit, old.relative) == tuple(spec):
+                budgets[i] = old
+            else:
+                budgets[i] = _Budget(_profiler.owner_name(cls), i, spec)
+    old_samplers = cls.__dict__.get("__dbc_samplers__", {})
+    samplers = {}
+    for i in invariants + list(soft_invariants):
+        if i.rate is not None:
+            old = old_samplers.get(i)
+            samplers[i] = old if old is not None and old.rate == i.rate else _Sampler(i.rate)
+
+    # __init__ is not wrapped, but must still not carry conditions
+    init = getattr(cls, "__init__", None)
+    init = getattr(init, "__func__", init)
+    if isinstance(init, types.FunctionType) and _has_conditions(init, ("pre", "post")):
+        raise AttributeError("__init__ must not have preconditions or postconditions")
+
+    # wrap every method once for this class and install the wrappers as
+    # class attributes; methods inherited from a base are only re-wrapped
+    # if this class adds soft invariants of its own
+    seen = set()
+    for c in mro:
+        for name, value in list(vars(c).items()):
+            if name in seen:
+                continue
+            seen.add(name)
+            if _is_dunder(name):
+                continue
+
+            # static and class methods are wrapped inside their descriptor,
+            # and have no instance to check invariants on
+            kind = type(value) if isinstance(value, (staticmethod, classmethod)) else None
+            if kind is not None:
+                value = value.__func__
+            func = getattr(value, "__dbc_func__", value)
+            if not isinstance(func, types.FunctionType):
+                continue
+            # at method boundaries, every invariant is checked around the
+            # public methods, and none around the others
+            additional = soft_invariants
+            if kind is not None:
+                additional = ()
+            elif boundary:
+                additional = () if name.startswith("_") else tuple(invariants) + soft_invariants
+            if getattr(value, "__dbc_additional__", None) == additional and \
+                    getattr(value, "__dbc_boundary__", False) == boundary:
+                continue
+
+            if additional or _has_conditions(func):
+                wrapper = _dbc_function(func, additional,
+                                        getattr(value, "__dbc_sample__", sample),
+                                        getattr(value, "__dbc_budget__", budget),
+                                        getattr(value, "__dbc_report__", report),
+                                        getattr(value, "__dbc_memo__", None) and
+                                        value.__dbc_memo__.maxsize, boundary)
+                setattr(cls, name, wrapper if kind is None else kind(wrapper))
+            elif c is cls and func is not value:
+                setattr(cls, name, func if kind is None else kind(func))
+
+    cls.__invariants__ = tuple(invariants)
+    cls.__dbc_soft_invariants__ = soft_invariants
+    cls.__dbc_budgets__ = budgets
+    cls.__dbc_samplers__ = samplers
+    _constrain(cls, mro, () if boundary else cls.__invariants__)
+
+
+# every decorated class, for prepare_all()
+_classes = weakref.WeakSet()
+
+
+def _dbc_class(cls, sample=None, budget=None, report=None, boundary=False):
+    global _generation
+    with _lock:
+        _generation += 1
+        cls.__dbc_stamp__ = _generation
+        _classes.add(cls)
+
+    cls.__dbc_sample__ = sample
+    cls.__dbc_budget__ = budget
+    cls.__dbc_report__ = report
+    # whether invariants are checked at the boundaries of public methods
+    # rather than on every assignment
+    cls.__dbc_boundary__ = boundary
+    cls.__dbc_sampler__ = _Sampler(sample)
+    cls.__dbc_statistics__ = _Counters()
 
     ####
     # define and set the new __init__
@@ -146,9 +1910,15 @@ def _dbc_class(cls):
 
     @wraps(orig__init__, assigned=("__name__", "__doc__"))
     def __init__(self, *args, **kwargs):
-        self.__invariants__ = []
-        self.__init_dbc__()
-        orig__init__(self, *args, **kwargs)
+        _class_table(self.__class__)
+        if not self.__class__.__dbc_boundary__:
+            orig__init__(self, *args, **kwargs)
+            return
+        # at method boundaries, the object is in a transaction until the
+        # outermost __init__ is done, and only then has to hold the
+        # invariants
+        with _Transaction(self):
+            orig__init__(self, *args, **kwargs)
     cls.__init__ = __init__
 
     ####
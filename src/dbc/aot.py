@@ -0,0 +1,63 @@
+# This file is part of dbc.
+#
+# dbc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbc.  If not, see <http://www.gnu.org/licenses/>.
+
+# Fills the cache of compiled wrappers ahead of time by importing all
+# modules of the given packages with the cache directory set, and preparing
+# everything they decorate:
+#
+#   python -m dbc.aot --cache-dir /var/cache/dbc mypackage
+
+import argparse
+import importlib
+import pkgutil
+import sys
+
+import dbc
+from dbc import cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill the dbc cache for packages ahead of time.")
+    parser.add_argument("packages", nargs="+")
+    parser.add_argument("--cache-dir", default=cache.get_cache_dir(),
+                        required=cache.get_cache_dir() is None)
+    args = parser.parse_args(argv)
+
+    cache.set_cache_dir(args.cache_dir)
+    failed = False
+    for name in args.packages:
+        package = importlib.import_module(name)
+        modules = [name]
+        if hasattr(package, "__path__"):
+            modules += [m[1] for m in pkgutil.walk_packages(package.__path__, name + ".")]
+        for module in modules:
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                sys.stderr.write("%s: %s\n" % (module, e))
+                failed = True
+    try:
+        dbc.prepare_all()
+    except Exception as e:
+        sys.stderr.write("%s\n" % e)
+        failed = True
+    info = cache.cache_info()
+    sys.stderr.write("%d wrappers, %d compiled, %d cached\n" % (
+        info["entries"], info["misses"], info["hits"]))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+# This file is part of dbc.
+#
+# dbc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbc.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compiled wrappers, keyed by a hash of what they are generated from: the
+# docstring, the signature and the options of the function, before anything
+# is parsed.  Each is kept with its recipe, which tells how to get the
+# values the code refers to, in memory, and if a cache directory is set
+# (with set_cache_dir() or DBC_CACHE_DIR), on disk marshalled like .pyc
+# files, so that other processes can skip parsing the conditions and
+# generating the wrappers.
+#
+# dbc.aot fills the cache ahead of time.
+
+import hashlib
+import marshal
+import os
+import tempfile
+import types
+
+try:
+    from importlib.util import MAGIC_NUMBER as _magic
+except ImportError:
+    import imp
+    _magic = imp.get_magic()
+
+# bumped whenever the generated code changes in a way its source does not
+# show
+_format = b"dbc-3"
+
+_memory = {}
+_directory = os.environ.get("DBC_CACHE_DIR") or None
+_info = {"hits": 0, "misses": 0}
+
+
+def set_cache_dir(path):
+    global _directory
+    _directory = path
+    if path is not None and not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def get_cache_dir():
+    return _directory
+
+
+def cache_info():
+    return dict(_info, entries=len(_memory))
+
+
+def key(parts):
+    h = hashlib.sha1(_magic + _format)
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode("utf-8")
+        h.update(b"\0" + part)
+    return h.hexdigest()
+
+
+def _path(key):
+    return os.path.join(_directory, key + ".dbc")
+
+
+def _valid(entry):
+    return isinstance(entry, tuple) and len(entry) == 2 and \
+        isinstance(entry[0], types.CodeType) and isinstance(entry[1], dict)
+
+
+def load(key):
+    # (code, recipe), or None
+    entry = _memory.get(key)
+    if entry is None and _directory is not None:
+        try:
+            with open(_path(key), "rb") as f:
+                entry = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            entry = None
+        if not _valid(entry):
+            entry = None
+        if entry is not None:
+            _memory[key] = entry
+    _info["misses" if entry is None else "hits"] += 1
+    return entry
+
+
+def store(key, code, recipe):
+    entry = _memory[key] = (code, recipe)
+    if _directory is None:
+        return
+    # written to a temporary file first, so that no process ever reads a
+    # partly written one
+    try:
+        if not os.path.isdir(_directory):
+            os.makedirs(_directory)
+        fd, tmp = tempfile.mkstemp(dir=_directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(marshal.dumps(entry))
+        os.rename(tmp, _path(key))
+    except (IOError, OSError):
+        pass
+
+
+def clear_cache():
+    _memory.clear()
+    for k in _info:
+        _info[k] = 0
+
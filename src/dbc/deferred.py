@@ -0,0 +1,142 @@
+# This file is part of dbc.
+#
+# dbc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbc.  If not, see <http://www.gnu.org/licenses/>.
+
+# Postconditions marked post[defer] are not checked by the wrapper, which
+# puts them on a bounded queue instead and returns right away.  Worker
+# threads check them in the background and pass every violation to the
+# handler set with set_deferred(), or keep it for flush() to raise.  When
+# the queue is full, checks are dropped and counted, or run inline.
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_workers = 1
+_queue_size = 1000
+_overflow = "drop"
+_handler = None
+
+_queue = None
+_threads = []
+# violations found while no handler was set, for flush()
+_violations = []
+_info = {"queued": 0, "checked": 0, "dropped": 0, "inline": 0, "violations": 0}
+_lock = threading.Lock()
+
+
+def set_deferred(workers=1, queue_size=1000, overflow="drop", handler=None):
+    # overflow is "drop" or "inline"; handler is called with the exception
+    # of every violated deferred check, in a worker thread
+    global _workers, _queue_size, _overflow, _handler
+    if workers < 1:
+        raise ValueError("Need at least one worker, not %r" % (workers,))
+    if queue_size < 1:
+        raise ValueError("Queue size must be positive, not %r" % (queue_size,))
+    if overflow not in ("drop", "inline"):
+        raise ValueError("Overflow must be 'drop' or 'inline', not %r" % (overflow,))
+    _stop()
+    _workers, _queue_size, _overflow, _handler = workers, queue_size, overflow, handler
+
+
+def deferred_info():
+    with _lock:
+        return dict(_info, pending=_queue.unfinished_tasks if _queue is not None else 0)
+
+
+def _start():
+    global _queue
+    with _lock:
+        if _queue is None:
+            q = queue.Queue(_queue_size)
+            for i in range(_workers):
+                t = threading.Thread(target=_work, args=(q,), name="dbc-deferred-%d" % i)
+                t.daemon = True
+                t.start()
+                _threads.append(t)
+            _queue = q
+    return _queue
+
+
+def _stop():
+    # lets the workers finish what is queued, then ends them
+    global _queue
+    with _lock:
+        q, _queue = _queue, None
+        threads = list(_threads)
+        del _threads[:]
+    if q is not None:
+        for t in threads:
+            q.put(None)
+        for t in threads:
+            t.join()
+
+
+def _work(q):
+    while True:
+        item = q.get()
+        try:
+            if item is None:
+                return
+            check, args = item
+            try:
+                check(*args)
+            except Exception as e:
+                _report(e)
+            with _lock:
+                _info["checked"] += 1
+        finally:
+            q.task_done()
+
+
+def _report(e):
+    with _lock:
+        _info["violations"] += 1
+        handler = _handler
+        if handler is None:
+            _violations.append(e)
+    if handler is not None:
+        handler(e)
+
+
+def defer(check, args):
+    # called by the wrappers: check(*args) raises if the condition is
+    # violated
+    q = _queue if _queue is not None else _start()
+    try:
+        q.put_nowait((check, args))
+    except queue.Full:
+        with _lock:
+            _info["inline" if _overflow == "inline" else "dropped"] += 1
+        if _overflow == "inline":
+            check(*args)
+        return
+    with _lock:
+        _info["queued"] += 1
+
+
+def flush():
+    # waits for every deferred check queued so far, then raises the first
+    # violation no handler has taken
+    q = _queue
+    if q is not None:
+        q.join()
+    with _lock:
+        violations = list(_violations)
+        del _violations[:]
+    if violations:
+        raise violations[0]
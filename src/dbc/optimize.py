@@ -0,0 +1,319 @@
+# This file is part of dbc.
+#
+# dbc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbc.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rewrites the conditions checked together, e.g. the postconditions of a
+# function, before their code is generated: constant sub-expressions are
+# folded, the conditions are ordered cheapest first, and calls that several
+# of them make with the same arguments are made once, their result kept in
+# a local variable.  Only calls of builtins and methods known not to change
+# anything are shared.  The trees of the conditions are never changed
+# themselves, only copies.
+
+import ast
+import copy
+import operator
+import sys
+
+_pure_functions = frozenset([
+    "abs", "all", "any", "bool", "callable", "chr", "divmod", "float", "frozenset",
+    "hasattr", "hash", "id", "int", "isinstance", "issubclass", "len", "list", "long",
+    "max", "min", "ord", "range", "repr", "round", "set", "sorted", "str", "sum", "tuple",
+    "type", "unicode", "xrange",
+    # the predicates
+    "all_finite", "is_permutation", "is_sorted", "non_negative", "same_shape",
+    "unchanged_except", "within_bounds",
+])
+_pure_methods = frozenset([
+    "count", "endswith", "find", "get", "index", "items", "keys", "lower", "split",
+    "startswith", "strip", "upper", "values",
+])
+
+# nodes that bind names of their own; nothing inside them is shared
+_scopes = tuple(getattr(ast, name) for name in
+                ("Lambda", "GeneratorExp", "ListComp", "SetComp", "DictComp") if hasattr(ast, name))
+
+_binary = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+           ast.Mod: operator.mod, ast.FloorDiv: operator.floordiv, ast.BitAnd: operator.and_,
+           ast.BitOr: operator.or_, ast.BitXor: operator.xor}
+_unary = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_,
+          ast.Invert: operator.invert}
+_compare = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+            ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge}
+_number_types = (bool, int, float, complex) + ((long,) if sys.version_info[0] == 2 else ())  # noqa: F821
+_string_types = (str, bytes) + ((unicode,) if sys.version_info[0] == 2 else ())  # noqa: F821
+
+_missing = object()
+
+
+def _constant(node):
+    # the value of a literal number, string, True, False or None
+    if sys.version_info >= (3, 8):
+        if not isinstance(node, ast.Constant):
+            return _missing
+        value = node.value
+    elif isinstance(node, ast.Num):
+        value = node.n
+    elif isinstance(node, ast.Str):
+        value = node.s
+    elif isinstance(node, getattr(ast, "NameConstant", ())):
+        value = node.value
+    elif isinstance(node, ast.Name) and node.id in ("True", "False", "None"):
+        value = {"True": True, "False": False, "None": None}[node.id]
+    else:
+        return _missing
+    if value is None or isinstance(value, _number_types + _string_types):
+        return value
+    return _missing
+
+
+def _constant_node(value, like):
+    if sys.version_info >= (3, 8):
+        node = ast.Constant(value=value)
+    elif value is None or isinstance(value, bool):
+        if hasattr(ast, "NameConstant"):
+            node = ast.NameConstant(value=value)
+        else:
+            node = ast.Name(id=repr(value), ctx=ast.Load())
+    elif isinstance(value, _number_types):
+        node = ast.Num(n=value)
+    else:
+        node = ast.Str(s=value)
+    return ast.copy_location(node, like)
+
+
+def _small(value):
+    # folded values that are not worth, or not safe, to compute in advance
+    if isinstance(value, _string_types):
+        return len(value) <= 256
+    if isinstance(value, int) and not isinstance(value, bool):
+        return abs(value) < 2 ** 64
+    return True
+
+
+class _Folder(ast.NodeTransformer):
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        left, right = _constant(node.left), _constant(node.right)
+        op = _binary.get(type(node.op))
+        if op is None or left is _missing or right is _missing or \
+                isinstance(left, _string_types) != isinstance(right, _string_types):
+            return node
+        return self._fold(node, op, left, right)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        operand = _constant(node.operand)
+        op = _unary.get(type(node.op))
+        if op is None or operand is _missing:
+            return node
+        return self._fold(node, op, operand)
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        values = [_constant(node.left)] + [_constant(c) for c in node.comparators]
+        ops = [_compare.get(type(op)) for op in node.ops]
+        if _missing in values or None in ops:
+            return node
+        return self._fold(node, lambda *values: all(op(a, b) for op, a, b in
+                                                    zip(ops, values, values[1:])), *values)
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        # only leading constants can be decided
+        values = list(node.values)
+        while len(values) > 1:
+            value = _constant(values[0])
+            if value is _missing:
+                break
+            if isinstance(node.op, ast.And) == bool(value):
+                values.pop(0)
+            else:
+                return values[0]
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+    def _fold(self, node, op, *args):
+        try:
+            value = op(*args)
+        except Exception:
+            # left for the check to fail on, as it would have
+            return node
+        if not (value is None or isinstance(value, _number_types + _string_types)) or \
+                not _small(value):
+            return node
+        return _constant_node(value, node)
+
+
+def fold(tree):
+    return ast.fix_missing_locations(_Folder().visit(copy.deepcopy(tree)))
+
+
+def cost(tree):
+    # a rough guess of what evaluating a condition takes: calls and
+    # comprehensions are expensive, everything else cheap
+    total = 0
+    for node in ast.walk(tree):
+        if isinstance(node, _scopes):
+            total += 25
+        elif isinstance(node, ast.Call):
+            total += 10
+        elif isinstance(node, (ast.Attribute, ast.Subscript)):
+            total += 2
+        else:
+            total += 1
+    return total
+
+
+def _children(node):
+    # the direct children of node, with whether they are evaluated every
+    # time node is
+    if isinstance(node, ast.BoolOp):
+        for i, child in enumerate(node.values):
+            yield child, i == 0
+    elif isinstance(node, ast.IfExp):
+        yield node.test, True
+        yield node.body, False
+        yield node.orelse, False
+    elif isinstance(node, ast.Compare):
+        # chained comparisons stop at the first false one
+        yield node.left, True
+        for i, child in enumerate(node.comparators):
+            yield child, i == 0
+    else:
+        for child in ast.iter_child_nodes(node):
+            yield child, True
+
+
+def _occurrences(tree, found, always=True):
+    # every node outside of nested scopes, with whether it is always
+    # evaluated
+    if isinstance(tree, _scopes):
+        return
+    found.append((tree, always))
+    for child, unconditional in _children(tree):
+        _occurrences(child, found, always and unconditional)
+
+
+def _pure(node, shadowed):
+    # whether evaluating node twice gives the same, and changes nothing
+    if _constant(node) is not _missing or isinstance(node, ast.Name):
+        return True
+    if isinstance(node, ast.Attribute):
+        return _pure(node.value, shadowed)
+    if isinstance(node, ast.Subscript):
+        return _pure(node.value, shadowed) and _pure(node.slice, shadowed)
+    if isinstance(node, getattr(ast, "Index", ())):
+        return _pure(node.value, shadowed)
+    if isinstance(node, ast.Slice):
+        return all(_pure(n, shadowed) for n in (node.lower, node.upper, node.step) if n is not None)
+    if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare, ast.BoolOp, ast.Tuple, ast.List)):
+        return all(_pure(n, shadowed) for n in ast.iter_child_nodes(node)
+                   if not isinstance(n, (ast.operator, ast.unaryop, ast.cmpop, ast.boolop,
+                                         ast.expr_context)))
+    if isinstance(node, ast.Call):
+        func = node.func
+        if isinstance(func, ast.Name):
+            if func.id not in _pure_functions or func.id in shadowed:
+                return False
+        elif isinstance(func, ast.Attribute):
+            if func.attr not in _pure_methods or not _pure(func.value, shadowed):
+                return False
+        else:
+            return False
+        if getattr(node, "starargs", None) or getattr(node, "kwargs", None):
+            return False
+        return all(_pure(a, shadowed) and not isinstance(a, getattr(ast, "Starred", ()))
+                   for a in node.args) and \
+            all(k.arg is not None and _pure(k.value, shadowed) for k in node.keywords)
+    return False
+
+
+def _size(node):
+    return sum(1 for _ in ast.walk(node))
+
+
+class _Replace(ast.NodeTransformer):
+    def __init__(self, key, name):
+        self.key = key
+        self.name = name
+
+    def visit(self, node):
+        if isinstance(node, _scopes):
+            return node
+        if isinstance(node, ast.expr) and ast.dump(node) == self.key:
+            return ast.copy_location(ast.Name(id=self.name, ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+
+def _share(trees, shareable, shadowed, private, prefix):
+    # {position: [(name, node)]}: the calls to make once before the
+    # condition at position, and the trees using their results
+    hoists = {}
+    while True:
+        # every pure call, where it is first always evaluated and how often
+        # it is evaluated from there on
+        first = {}
+        nodes = {}
+        counts = {}
+        for pos, tree in enumerate(trees):
+            if tree is None or not shareable[pos]:
+                continue
+            found = []
+            _occurrences(tree, found)
+            for node, always in found:
+                if not isinstance(node, ast.Call):
+                    continue
+                key = ast.dump(node)
+                if key in first:
+                    counts[key] += 1
+                elif always:
+                    first[key] = pos
+                    nodes[key] = node
+                    counts[key] = 1
+        candidates = [key for key in counts if counts[key] > 1]
+        candidates = [key for key in candidates if _pure(nodes[key], shadowed) and
+                      not any(isinstance(n, ast.Name) and n.id in private for n in ast.walk(nodes[key]))]
+        if not candidates:
+            return hoists, trees
+        # the largest first, so that what it contains is not shared on its own
+        key = max(candidates, key=lambda k: (_size(nodes[k]), -first[k], k))
+        name = "%s%d" % (prefix, sum(len(h) for h in hoists.values()))
+        hoists.setdefault(first[key], []).append((name, copy.deepcopy(nodes[key])))
+        replace = _Replace(key, name)
+        trees = [tree if tree is None or pos < first[key] or not shareable[pos]
+                 else replace.visit(copy.deepcopy(tree)) for pos, tree in enumerate(trees)]
+
+
+def optimize(trees, plain, shadowed, private, prefix):
+    # trees are the conditions in the order they are written; plain tells
+    # which of them are checked on every call, without sampling or budget.
+    # Returns the order to check them in, the calls to make once before
+    # the condition at a position, and the rewritten trees, None for those
+    # that can never fail.  Names in shadowed are not builtins, names in
+    # private are never shared
+    folded = [fold(tree) for tree in trees]
+    costs = [cost(tree) for tree in folded]
+    order = sorted(range(len(trees)), key=lambda i: costs[i])
+    ordered = []
+    for i in order:
+        value = _constant(folded[i])
+        ordered.append(None if plain[i] and value is not _missing and value else folded[i])
+    hoists, ordered = _share(ordered, [plain[i] for i in order], shadowed, private, prefix)
+    for pos, tree in enumerate(ordered):
+        if tree is not None:
+            ordered[pos] = ast.fix_missing_locations(tree)
+    return order, hoists, ordered
@@ -0,0 +1,121 @@
+# This file is part of dbc.
+#
+# dbc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbc.  If not, see <http://www.gnu.org/licenses/>.
+
+# Predicates over sequences that conditions can use without importing
+# anything.  NumPy arrays are checked with vectorized operations, everything
+# else element by element.  NumPy is never imported here: if it has not been
+# imported by anyone else, no array can have been passed.
+
+import collections
+import math
+import sys
+from itertools import tee
+
+
+def _numpy(*values):
+    np = sys.modules.get("numpy")
+    if np is not None and any(isinstance(v, np.ndarray) for v in values):
+        return np
+    return None
+
+
+def _finite(x):
+    return not (math.isinf(x) or math.isnan(x))
+
+
+def is_sorted(a, strict=False):
+    np = _numpy(a)
+    if np is not None:
+        a = np.ravel(a)
+        return bool(np.all(a[:-1] < a[1:] if strict else a[:-1] <= a[1:]))
+    # pairs of neighbours; tee() makes this work for iterators, too
+    a, b = tee(a)
+    next(b, None)
+    if strict:
+        return all(x < y for x, y in zip(a, b))
+    return all(x <= y for x, y in zip(a, b))
+
+
+def non_negative(a):
+    np = _numpy(a)
+    if np is not None:
+        return bool(np.all(a >= 0))
+    return all(x >= 0 for x in a)
+
+
+def all_finite(a):
+    np = _numpy(a)
+    if np is not None:
+        return bool(np.all(np.isfinite(a)))
+    return all(_finite(x) for x in a)
+
+
+def within_bounds(a, lo, hi):
+    # lo <= x <= hi for every element x
+    np = _numpy(a)
+    if np is not None:
+        return bool(np.all((a >= lo) & (a <= hi)))
+    return all(lo <= x <= hi for x in a)
+
+
+def _is_sequence(a):
+    return isinstance(a, (list, tuple))
+
+
+def same_shape(a, b):
+    np = _numpy(a, b)
+    if np is not None:
+        return np.shape(a) == np.shape(b)
+    # nested lists and tuples have the same shape if they have the same
+    # lengths all the way down
+    if not (_is_sequence(a) and _is_sequence(b)):
+        return _is_sequence(a) == _is_sequence(b)
+    return len(a) == len(b) and all(same_shape(x, y) for x, y in zip(a, b))
+
+
+def is_permutation(a, b):
+    # a and b have the same elements, each as often
+    np = _numpy(a, b)
+    if np is not None:
+        a, b = np.asarray(a), np.asarray(b)
+        return a.shape == b.shape and bool(np.array_equal(np.sort(a, axis=None), np.sort(b, axis=None)))
+    a, b = list(a), list(b)
+    if len(a) != len(b):
+        return False
+    try:
+        return sorted(a) == sorted(b)
+    except TypeError:
+        # elements that cannot be ordered have to be hashable at least
+        return collections.Counter(a) == collections.Counter(b)
+
+
+def unchanged_except(new, old, mask):
+    # new equals old wherever mask is false, e.g.
+    # post: unchanged_except(a, __old__["a"], [i == k for i in range(len(a))])
+    np = _numpy(new, old, mask)
+    if np is not None:
+        new, old, mask = np.asarray(new), np.asarray(old), np.asarray(mask, dtype=bool)
+        if new.shape != old.shape or mask.shape != new.shape:
+            return False
+        keep = ~mask
+        return bool(np.array_equal(new[keep], old[keep]))
+    new, old, mask = list(new), list(old), list(mask)
+    if not len(new) == len(old) == len(mask):
+        return False
+    return all(n == o for n, o, m in zip(new, old, mask) if not m)
+
+
+predicates = dict((f.__name__, f) for f in (is_sorted, non_negative, all_finite, within_bounds,
+                                            same_shape, is_permutation, unchanged_except))
@@ -0,0 +1,115 @@
+# This file is part of dbc.
+#
+# dbc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbc.  If not, see <http://www.gnu.org/licenses/>.
+
+# What contracts cost: while profiling is switched on, every evaluation of a
+# condition, every snapshot taken for __old__ and old(...), and every
+# invariant check triggered by an attribute assignment is recorded here,
+# per decorated function or class.
+
+import sys
+import time
+
+clock = getattr(time, "perf_counter", time.time)
+
+# (owner, condition) -> [evaluations, total time, max time]
+_conditions = {}
+# owner -> [snapshots, total time, bytes]
+_snapshots = {}
+# (owner, attribute) -> invariant checks
+_attributes = {}
+
+
+def owner_name(elem):
+    return "%s.%s" % (elem.__module__, getattr(elem, "__qualname__", elem.__name__))
+
+
+def record_condition(owner, cond, elapsed):
+    try:
+        r = _conditions[owner, cond.text]
+    except KeyError:
+        r = _conditions[owner, cond.text] = [0, 0.0, 0.0]
+    r[0] += 1
+    r[1] += elapsed
+    if elapsed > r[2]:
+        r[2] = elapsed
+
+
+def record_snapshot(owner, elapsed, values):
+    try:
+        r = _snapshots[owner]
+    except KeyError:
+        r = _snapshots[owner] = [0, 0.0, 0]
+    r[0] += 1
+    r[1] += elapsed
+    r[2] += sum(_sizeof(v, set()) for v in values)
+
+
+def record_attribute(owner, name):
+    key = owner, name
+    _attributes[key] = _attributes.get(key, 0) + 1
+
+
+def _sizeof(value, seen):
+    # the memory a snapshot holds on to: containers are followed, objects
+    # already counted (e.g. immutables shared with the original) are not
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, dict):
+        size += sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_sizeof(v, seen) for v in value)
+    elif hasattr(value, "__dict__"):
+        size += _sizeof(value.__dict__, seen)
+    return size
+
+
+def profile():
+    # the records so far, the most expensive first
+    conditions = [{"owner": owner, "condition": text, "count": count,
+                   "total": total, "max": max_, "mean": total / count}
+                  for (owner, text), (count, total, max_) in _conditions.items()]
+    conditions.sort(key=lambda r: (-r["total"], r["owner"], r["condition"]))
+    snapshots = [{"owner": owner, "count": count, "total": total, "bytes": size}
+                 for owner, (count, total, size) in _snapshots.items()]
+    snapshots.sort(key=lambda r: (-r["total"], r["owner"]))
+    attributes = [{"owner": owner, "attribute": name, "checks": checks}
+                  for (owner, name), checks in _attributes.items()]
+    attributes.sort(key=lambda r: (-r["checks"], r["owner"], r["attribute"]))
+    return {"conditions": conditions, "snapshots": snapshots, "attributes": attributes}
+
+
+def print_profile(file=None):
+    file = sys.stdout if file is None else file
+    report = profile()
+    file.write("%10s %12s %12s %12s  %s\n" % ("count", "total [s]", "mean [s]", "max [s]", "condition"))
+    for r in report["conditions"]:
+        file.write("%10d %12.6f %12.6f %12.6f  %s: %s\n" % (
+            r["count"], r["total"], r["mean"], r["max"], r["owner"], r["condition"]))
+    if report["snapshots"]:
+        file.write("\n%10s %12s %12s  %s\n" % ("count", "total [s]", "bytes", "snapshots"))
+        for r in report["snapshots"]:
+            file.write("%10d %12.6f %12d  %s\n" % (r["count"], r["total"], r["bytes"], r["owner"]))
+    if report["attributes"]:
+        file.write("\n%10s  %s\n" % ("checks", "attribute"))
+        for r in report["attributes"]:
+            file.write("%10d  %s.%s\n" % (r["checks"], r["owner"], r["attribute"]))
+
+
+def reset_profile():
+    _conditions.clear()
+    _snapshots.clear()
+    _attributes.clear()
@@ -0,0 +1,106 @@
+# This file is part of dbc.
+#
+# dbc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbc.  If not, see <http://www.gnu.org/licenses/>.
+
+# Violations recorded instead of raised: every violation is counted per
+# condition and appended to a ring buffer of the most recent ones; only the
+# first few of each condition keep the values of the names the condition
+# could see, as reprs.  A handler can be called for them, at most a given
+# number of times per second.
+
+import collections
+import threading
+import time
+
+try:
+    from reprlib import Repr
+except ImportError:
+    from repr import Repr
+
+_repr = Repr()
+_repr.maxstring = _repr.maxother = 80
+
+_size = 1000
+_capture = 10
+_handler = None
+_handler_rate = 1.0
+
+_recent = collections.deque(maxlen=_size)
+# condition -> violations
+_counts = {}
+# handler calls left out because of the rate limit
+_suppressed = [0]
+_last_handled = [None]
+_lock = threading.Lock()
+
+
+def configure(size=1000, capture=10, handler=None, handler_rate=1.0):
+    global _size, _capture, _handler, _handler_rate, _recent
+    if size < 1:
+        raise ValueError("Buffer size must be positive, not %r" % (size,))
+    if handler_rate <= 0:
+        raise ValueError("Handler rate must be positive, not %r" % (handler_rate,))
+    with _lock:
+        _size, _capture, _handler, _handler_rate = size, capture, handler, handler_rate
+        _recent = collections.deque(_recent, maxlen=size)
+
+
+def _values(values):
+    result = {}
+    for k, v in values.items():
+        if not k.startswith("_dbc_"):
+            try:
+                result[k] = _repr.repr(v)
+            except Exception:
+                result[k] = "<unrepresentable %s>" % type(v).__name__
+    return result
+
+
+def record(text, values=None):
+    with _lock:
+        count = _counts[text] = _counts.get(text, 0) + 1
+        captured = _values(values) if count <= _capture and values is not None else None
+        entry = (text, count, time.time(), threading.current_thread().name, captured)
+        _recent.append(entry)
+        handler = _handler
+        if handler is not None:
+            now = time.time()
+            last = _last_handled[0]
+            if last is not None and now - last < 1.0 / _handler_rate:
+                _suppressed[0] += 1
+                handler = None
+            else:
+                _last_handled[0] = now
+    if handler is not None:
+        handler(_entry(entry))
+
+
+def _entry(entry):
+    text, count, when, thread, values = entry
+    return {"condition": text, "count": count, "time": when, "thread": thread, "values": values}
+
+
+def violations():
+    # the counters and the buffered violations, the oldest first
+    with _lock:
+        return {"counts": dict(_counts), "recent": [_entry(e) for e in _recent],
+                "suppressed": _suppressed[0]}
+
+
+def reset_violations():
+    with _lock:
+        _recent.clear()
+        _counts.clear()
+        _suppressed[0] = 0
+        _last_handled[0] = None
@@ -0,0 +1,272 @@
+# This file is part of dbc.
+#
+# dbc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbc.  If not, see <http://www.gnu.org/licenses/>.
+
+# Snapshots of values taken before a call for __old__ and old(...).
+#
+# A snapshot strategy is a callable taking the value and returning what the
+# postconditions get to see instead of it.  Strategies are looked up by
+# type (registered with register_snapshot(), either as a class or as a
+# "module.ClassName" string so optional libraries need not be imported),
+# then via a __dbc_snapshot__() method on the value; everything else is
+# deep-copied.  A strategy may return NO_SNAPSHOT, in which case the
+# postconditions depending on the value are skipped for that call.
+
+import copy
+import hashlib
+import sys
+
+if sys.version_info[0] < 3:
+    _immutable = frozenset((type(None), bool, int, long, float, complex,  # noqa: F821
+                            str, unicode, type, type(len), xrange, slice))  # noqa: F821
+else:
+    _immutable = frozenset((type(None), bool, int, float, complex, str,
+                            bytes, type, type(len), range, slice))
+
+
+class _NoSnapshot(object):
+    def __repr__(self):
+        return "NO_SNAPSHOT"
+
+
+NO_SNAPSHOT = _NoSnapshot()
+
+# largest size (number of items for containers, number of bytes for
+# buffers) that is copied; None means no limit
+_limit = None
+
+
+def set_snapshot_limit(limit):
+    global _limit
+    _limit = limit
+
+
+def get_snapshot_limit():
+    return _limit
+
+
+def _too_large(size):
+    return _limit is not None and size > _limit
+
+
+class Fingerprint(object):
+    # stands in for a buffer that is too large (or too volatile) to copy;
+    # it compares equal to any buffer with the same length and contents
+    __slots__ = ("length", "digest")
+
+    def __init__(self, data):
+        self.length = len(data)
+        self.digest = _digest(data)
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if isinstance(other, Fingerprint):
+            return self.length == other.length and self.digest == other.digest
+        try:
+            return self.length == len(other) and self.digest == _digest(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<Fingerprint of %d items: %s>" % (self.length, self.digest)
+
+
+def _digest(data):
+    try:
+        return hashlib.sha1(memoryview(data)).hexdigest()
+    except (TypeError, ValueError, BufferError):
+        # non-contiguous buffers have to be flattened first
+        return hashlib.sha1(data.tobytes()).hexdigest()
+
+
+def _snapshot_immutable(value):
+    return value
+
+
+def _snapshot_items(values, memo, items=None):
+    # shared by all containers: elements that are immutable themselves are
+    # shared with the original, only mutable ones are snapshot recursively
+    if items is None:
+        items = []
+    for v in values:
+        if type(v) not in _immutable:
+            v = snapshot(v, memo)
+            if v is NO_SNAPSHOT:
+                return NO_SNAPSHOT
+        items.append(v)
+    return items
+
+
+def _snapshot_tuple(value, memo):
+    items = _snapshot_items(value, memo)
+    if items is NO_SNAPSHOT:
+        return NO_SNAPSHOT
+    # a tuple can only contain itself through a mutable item, which already
+    # made its snapshot
+    if id(value) in memo:
+        return memo[id(value)]
+    if all(a is b for a, b in zip(items, value)):
+        result = value
+    else:
+        result = tuple(items)
+    memo[id(value)] = result
+    return result
+
+
+def _snapshot_list(value, memo):
+    if _too_large(len(value)):
+        return NO_SNAPSHOT
+    # known before the items are, for lists containing themselves
+    items = memo[id(value)] = []
+    if _snapshot_items(value, memo, items) is NO_SNAPSHOT:
+        return NO_SNAPSHOT
+    return items
+
+
+def _snapshot_set(value, memo):
+    # hashable elements may still change, when they are hashed by identity,
+    # so only immutable ones are shared
+    if _too_large(len(value)):
+        return NO_SNAPSHOT
+    if all(type(v) in _immutable for v in value):
+        result = value if type(value) is frozenset else set(value)
+    else:
+        items = _snapshot_items(value, memo)
+        if items is NO_SNAPSHOT:
+            return NO_SNAPSHOT
+        try:
+            if type(value) is frozenset and all(a is b for a, b in zip(items, value)):
+                result = value
+            else:
+                result = type(value)(items)
+        except TypeError:
+            # a snapshot that cannot be hashed
+            return copy.deepcopy(value, memo)
+    memo[id(value)] = result
+    return result
+
+
+def _snapshot_dict(value, memo):
+    if _too_large(len(value)):
+        return NO_SNAPSHOT
+    result = memo[id(value)] = {}
+    values = _snapshot_items(value.values(), memo)
+    if values is NO_SNAPSHOT:
+        return NO_SNAPSHOT
+    result.update(zip(value.keys(), values))
+    return result
+
+
+def _snapshot_bytearray(value):
+    if _too_large(len(value)):
+        return Fingerprint(value)
+    return bytes(value)
+
+
+def _snapshot_memoryview(value):
+    # a view on immutable bytes can be shared, anything else may change
+    # underneath it and is fingerprinted instead of copied
+    if value.readonly and isinstance(getattr(value, "obj", None), bytes):
+        return value
+    return Fingerprint(value)
+
+
+def _snapshot_ndarray(value):
+    if _too_large(value.nbytes):
+        return Fingerprint(value)
+    return value.copy()
+
+
+def _snapshot_hook(value):
+    return value.__dbc_snapshot__()
+
+
+def _snapshot_default(value, memo):
+    # old-style instances all share one type, so the hook can only be
+    # found on the value itself
+    hook = getattr(value, "__dbc_snapshot__", None)
+    if hook is not None:
+        return hook()
+    # try copying deep, if that does not work, copy only the first level
+    try:
+        return copy.deepcopy(value, memo)
+    except TypeError:
+        return copy.copy(value)
+
+
+# registered strategies, keyed by class or by "module.ClassName"
+_registry = {
+    tuple: _snapshot_tuple,
+    frozenset: _snapshot_set,
+    list: _snapshot_list,
+    set: _snapshot_set,
+    dict: _snapshot_dict,
+    bytearray: _snapshot_bytearray,
+    memoryview: _snapshot_memoryview,
+    "numpy.ndarray": _snapshot_ndarray,
+}
+for _t in _immutable:
+    _registry[_t] = _snapshot_immutable
+
+# strategies taking the memo along with the value
+_recursive = frozenset((_snapshot_tuple, _snapshot_list, _snapshot_set, _snapshot_dict,
+                        _snapshot_default))
+
+# the built-in container strategies rebuild plain containers, so they are
+# not used for subclasses of them
+_exact = frozenset((tuple, list, set, frozenset, dict, bytearray))
+
+# strategies resolved for concrete types, filled on first use
+_resolved = {}
+
+
+def register_snapshot(cls, strategy):
+    _registry[cls] = strategy
+    _resolved.clear()
+
+
+def _resolve(cls):
+    for c in getattr(cls, "__mro__", (cls,)):
+        name = "%s.%s" % (getattr(c, "__module__", None), c.__name__)
+        for key in (c, name):
+            if key in _registry and (c is cls or c not in _exact):
+                return _registry[key]
+        if "__dbc_snapshot__" in getattr(c, "__dict__", ()):
+            return _snapshot_hook
+    return _snapshot_default
+
+
+def snapshot(value, memo=None):
+    # memo maps the ids of the values snapshot so far to their snapshots, as
+    # for deepcopy, so that values containing themselves or the same value
+    # twice are snapshot the same way
+    cls = type(value)
+    try:
+        strategy = _resolved[cls]
+    except KeyError:
+        strategy = _resolved[cls] = _resolve(cls)
+    if strategy not in _recursive:
+        return strategy(value)
+    if memo is None:
+        memo = {}
+    elif id(value) in memo:
+        return memo[id(value)]
+    return strategy(value, memo)
@@ -14,11 +14,51 @@
 # along with dbc.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
-from dbc import dbc, DbcViolation
+from dbc import dbc, DbcViolation, register_snapshot, snapshot, set_snapshot_limit, \
+    statistics, reset_statistics, Fingerprint, NO_SNAPSHOT, set_level, \
+    get_level, OFF, PRE, POST, FULL, set_sample_rate, transaction, \
+    set_profiling, profile, reset_profile, is_sorted, non_negative, all_finite, \
+    within_bounds, same_shape, is_permutation, unchanged_except, set_budget, \
+    demotions, reset_demotions, set_cache_dir, cache_info, clear_cache, prepare, \
+    prepare_all, set_deferred, deferred_info, flush, set_report, violations, \
+    reset_violations, memo_info, clear_memo
+import gc
+import logging
 import math
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _CapturedLogs(logging.Handler):
+    # keeps the records of the dbc logger from reaching stderr, like
+    # assertLogs(), which Python 2 does not have
+    def __enter__(self):
+        self.records = []
+        logger = logging.getLogger("dbc")
+        self.propagate = logger.propagate
+        logger.addHandler(self)
+        logger.propagate = False
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        logger = logging.getLogger("dbc")
+        logger.removeHandler(self)
+        logger.propagate = self.propagate
+
+    def emit(self, record):
+        self.records.append(record)
 
 
 class Test(unittest.TestCase):
+    def _budgetLogs(self):
+        if hasattr(self, "assertLogs"):
+            return self.assertLogs("dbc", "WARNING")
+        return _CapturedLogs()
+
     def testAssignmentViolation(self):
         @dbc
         class X:
@@ -864,5 +904,1929 @@ class Test(unittest.TestCase):
         with self.assertRaises(DbcViolation):
             x.x = 9
 
+    def testConditionsCompiledOnce(self):
+        @dbc
+        def f(a):
+            """
+            pre: a > 0
+            """
+            return a
+
+        @dbc
+        def g(a):
+            """
+            pre: a > 0
+            """
+            return a
+
+        prepare(f)
+        prepare(g)
+        self.assertIs(f.__pres__[0], g.__pres__[0])
+        try:
+            f(0)
+        except DbcViolation as e:
+            self.assertEqual(e.con, "a > 0")
+        else:
+            self.fail("DbcViolation not raised")
+
+    def testClassLevelWrappers(self):
+        @dbc
+        class X(object):
+            """
+            hinv: self.bla > 5
+            sinv: self.bla < 20
+            """
+            def __init__(self):
+                self.bla = 10
+
+            def change(self, value):
+                """
+                pre: value > 0
+                """
+                self.bla = value
+
+        x1 = X()
+        x2 = X()
+        self.assertEqual(list(x1.__dict__), ["bla"])
+        self.assertIs(x1.__invariants__, x2.__invariants__)
+        x1.change(12)
+        with self.assertRaises(DbcViolation):
+            x2.change(0)
+        with self.assertRaises(DbcViolation):
+            x2.change(25)
+
+    def testSubclassSoftInvariants(self):
+        @dbc
+        class X(object):
+            def __init__(self):
+                self.bla = 10
+
+            def change(self, value):
+                self.bla = value
+
+        class Y(X):
+            """
+            sinv: self.bla < 20
+            """
+            pass
+
+        X().change(25)
+        Y().change(15)
+        with self.assertRaises(DbcViolation):
+            Y().change(25)
+        X().change(25)
+
+    def testOldExpression(self):
+        @dbc
+        class Counter(object):
+            def __init__(self):
+                self.count = 0
+
+            def increment(self, by):
+                """
+                post: self.count == old(self.count) + by
+                """
+                self.count += by
+
+            def broken(self, by):
+                """
+                post: self.count == old(self.count) + by
+                """
+                self.count += by + 1
+
+        c = Counter()
+        c.increment(2)
+        c.increment(3)
+        self.assertEqual(c.count, 5)
+        with self.assertRaises(DbcViolation):
+            c.broken(1)
+
+    def testOldBoundWithinCondition(self):
+        @dbc
+        def f(a, x):
+            """
+            post: all(y == old(y) for y in a)
+            """
+        with self.assertRaises(AttributeError):
+            f([1], 0)
+
+        @dbc
+        def g(a):
+            """
+            post: (lambda b: b == old(b))(a)
+            """
+        with self.assertRaises(AttributeError):
+            g(1)
+
+        @dbc
+        def h(a, x):
+            """
+            post: [y for y in old(list(a)) if y != old(x)] + [x] == a
+            post: (lambda b=old(x): b)() == x
+            """
+            a.append(x)
+        h([1], 2)
+
+    def testOldExpressionAppend(self):
+        @dbc
+        def append(a, x):
+            """
+            post: len(a) == old(len(a)) + 1
+            post: a[-1] == x
+            """
+            a.append(x)
+
+        @dbc
+        def append_broken(a, x):
+            """
+            post: len(a) == old(len(a)) + 1
+            """
+            a.extend([x, x])
+
+        append([1, 2], 3)
+        with self.assertRaises(DbcViolation):
+            append_broken([1, 2], 3)
+
+    def testOldInPrecondition(self):
+        @dbc
+        def f(a):
+            """
+            pre: old(a) > 0
+            """
+            pass
+        with self.assertRaises(AttributeError):
+            f(1)
+
+    def testNoSnapshotWithoutOld(self):
+        copies = []
+
+        class Uncopyable(object):
+            def __deepcopy__(self, memo):
+                copies.append(self)
+                return Uncopyable()
+
+        @dbc
+        def f(a):
+            """
+            post: __ret__ is a
+            """
+            return a
+
+        @dbc
+        def g(a):
+            """
+            post: __old__["a"] is not a
+            """
+            return a
+
+        f(Uncopyable())
+        self.assertEqual(copies, [])
+        g(Uncopyable())
+        self.assertEqual(len(copies), 1)
+
+    def testSnapshotLimit(self):
+        @dbc
+        def mysort(a):
+            """
+            post: len(__ret__) == len(__old__["a"])
+            post: __ret__ is a
+            """
+            a.append(0)
+            return a
+
+        reset_statistics()
+        set_snapshot_limit(3)
+        try:
+            mysort([4, 3, 1, 2, 1])
+            self.assertEqual(statistics()["postconditions_skipped"], 1)
+            with self.assertRaises(DbcViolation):
+                mysort([4, 3])
+        finally:
+            set_snapshot_limit(None)
+        with self.assertRaises(DbcViolation):
+            mysort([4, 3, 1, 2, 1])
+
+    def testSnapshotSharesImmutables(self):
+        item = (1, "a")
+
+        @dbc
+        def f(a):
+            """
+            post: __old__["a"] is not a
+            post: __old__["a"][0] is a[0]
+            post: old(a[1]) == a[1] and old(a[1]) is not a[1]
+            """
+            a.reverse()
+
+        f([item, [1, 2], item])
+
+    def testSnapshotCycles(self):
+        x = [1]
+        x.append(x)
+        s = snapshot(x)
+        self.assertIsNot(s, x)
+        self.assertIs(s[1], s)
+
+        d = {"a": [1]}
+        d["self"] = d
+        s = snapshot(d)
+        self.assertIsNot(s, d)
+        self.assertIs(s["self"], s)
+        self.assertIsNot(s["a"], d["a"])
+
+        t = ([],)
+        t[0].append(t)
+        s = snapshot(t)
+        self.assertIsNot(s, t)
+        self.assertIs(s[0][0], s)
+
+    def testSnapshotAliasing(self):
+        @dbc
+        def f(a):
+            """
+            post: __old__["a"][0] is __old__["a"][1]
+            post: __old__["a"][0] is not a[0]
+            """
+            a[0].append(1)
+
+        inner = []
+        f([inner, inner])
+
+    def testSnapshotSetElements(self):
+        class Item(object):
+            def __init__(self):
+                self.v = 0
+
+        @dbc
+        def f(s):
+            """
+            post: all(x.v == 0 for x in __old__["s"])
+            post: all(x.v == 1 for x in s)
+            """
+            for x in s:
+                x.v = 1
+
+        f(set([Item(), Item()]))
+        f(frozenset([Item()]))
+        items = frozenset([1, (2, "a")])
+        self.assertIs(snapshot(items), items)
+
+    def testSnapshotHook(self):
+        class Big(object):
+            def __init__(self):
+                self.data = list(range(100))
+
+            def __dbc_snapshot__(self):
+                return len(self.data)
+
+        class Other(object):
+            pass
+
+        register_snapshot(Other, lambda v: NO_SNAPSHOT)
+
+        @dbc
+        def grow(a):
+            """
+            post: len(a.data) == old(a) + 1
+            """
+            a.data.append(0)
+
+        @dbc
+        def skipped(a):
+            """
+            post: False and old(a)
+            """
+            pass
+
+        grow(Big())
+        reset_statistics()
+        skipped(Other())
+        self.assertEqual(statistics()["postconditions_skipped"], 1)
+
+    def testSnapshotFingerprint(self):
+        @dbc
+        def unchanged(a, i):
+            """
+            post: old(a) == a
+            """
+            a[i] = a[i]
+
+        @dbc
+        def changed(a, i):
+            """
+            post: old(a) == a
+            """
+            a[i] = (a[i] + 1) % 256
+
+        set_snapshot_limit(3)
+        try:
+            unchanged(bytearray(b"abcdef"), 2)
+            with self.assertRaises(DbcViolation):
+                changed(bytearray(b"abcdef"), 2)
+        finally:
+            set_snapshot_limit(None)
+        self.assertEqual(Fingerprint(b"abc"), bytearray(b"abc"))
+        self.assertNotEqual(Fingerprint(b"abc"), b"abd")
+
+    def testKeywordArguments(self):
+        @dbc
+        def scale(a, factor=2, *rest, **options):
+            """
+            pre: factor > 0
+            pre: len(rest) < 2
+            pre: options.get("offset", 0) >= 0
+            post: __ret__ >= a
+            """
+            return a * factor + options.get("offset", 0)
+
+        self.assertEqual(scale(3), 6)
+        self.assertEqual(scale(3, factor=3), 9)
+        self.assertEqual(scale(a=3, factor=1, offset=2), 5)
+        self.assertEqual(scale(3, 1, 0), 3)
+        with self.assertRaises(DbcViolation):
+            scale(3, factor=0)
+        with self.assertRaises(DbcViolation):
+            scale(3, 1, 0, 0)
+        with self.assertRaises(DbcViolation):
+            scale(3, offset=-1)
+        with self.assertRaises(TypeError):
+            scale(factor=3)
+
+    def testKeywordArgumentsOld(self):
+        @dbc
+        def extend(a, b=()):
+            """
+            post: len(a) == len(__old__["a"]) + len(b)
+            """
+            a.extend(b)
+
+        extend(a=[1], b=[2, 3])
+        extend([1])
+
+    def testBoundMethod(self):
+        class X(object):
+            def __init__(self):
+                self.bla = 10
+
+            def change(self, value):
+                """
+                pre: value > self.bla
+                """
+                self.bla = value
+
+        x = X()
+        change = dbc(x.change)
+        change(11)
+        change(value=12)
+        self.assertEqual(x.bla, 12)
+        with self.assertRaises(DbcViolation):
+            change(5)
+
+    @unittest.skipIf(sys.version_info[0] < 3, "keyword-only arguments need Python 3")
+    def testKeywordOnlyArguments(self):
+        ns = {}
+        exec("def f(a, *, b, c=3):\n"
+             "    '''\n"
+             "    pre: b > a\n"
+             "    post: __ret__ == a + b + c\n"
+             "    '''\n"
+             "    return a + b + c\n", ns)
+        f = dbc(ns["f"])
+        self.assertEqual(f(1, b=2), 6)
+        with self.assertRaises(DbcViolation):
+            f(1, b=0)
+
+    def testLevelOffAtDecoration(self):
+        set_level(OFF)
+        try:
+            def f(a):
+                """
+                pre: a > 0
+                """
+                return a
+
+            class X(object):
+                """
+                hinv: self.bla > 5
+                """
+                def __init__(self):
+                    self.bla = 0
+
+            self.assertIs(dbc(f), f)
+            self.assertIs(dbc(X), X)
+            self.assertNotIn("__setattr__", X.__dict__)
+            X()
+        finally:
+            set_level(FULL)
+
+    def testLevelAtRuntime(self):
+        @dbc
+        class X(object):
+            """
+            hinv: self.bla > 5
+            sinv: self.bla < 20
+            """
+            def __init__(self):
+                self.bla = 10
+
+            def change(self, value):
+                """
+                pre: value != 0
+                post: self.bla == value
+                """
+                self.bla = abs(value)
+
+        x = X()
+        try:
+            set_level("post")
+            x.bla = 0
+            x.change(30)
+            with self.assertRaises(DbcViolation):
+                x.change(-7)
+            set_level(PRE)
+            x.change(-7)
+            with self.assertRaises(DbcViolation):
+                x.change(0)
+            set_level("off")
+            x.change(0)
+        finally:
+            set_level(FULL)
+        with self.assertRaises(DbcViolation):
+            x.bla = 0
+
+    def testParseLevel(self):
+        self.assertEqual(get_level(), FULL)
+        try:
+            set_level("2")
+            self.assertEqual(get_level(), POST)
+            set_level(" Pre ")
+            self.assertEqual(get_level(), PRE)
+            with self.assertRaises(ValueError):
+                set_level("everything")
+            with self.assertRaises(ValueError):
+                set_level(4)
+        finally:
+            set_level(FULL)
+
+    def testSampledFunction(self):
+        @dbc(sample=0.25)
+        def f(a):
+            """
+            pre: a > 0
+            """
+            return a
+
+        violations = 0
+        for _ in range(8):
+            try:
+                f(0)
+            except DbcViolation:
+                violations += 1
+        self.assertEqual(violations, 2)
+        self.assertEqual(statistics(f), {"checked": 2, "skipped": 6})
+        reset_statistics(f)
+        self.assertEqual(statistics(f), {"checked": 0, "skipped": 0})
+
+    def testGlobalSampleRate(self):
+        @dbc
+        def f(a):
+            """
+            pre: a > 0
+            """
+            return a
+
+        reset_statistics()
+        set_sample_rate(0.5)
+        try:
+            self.assertEqual(f(0), 0)
+            with self.assertRaises(DbcViolation):
+                f(0)
+        finally:
+            set_sample_rate(1)
+        with self.assertRaises(DbcViolation):
+            f(0)
+        self.assertEqual(statistics()["calls_checked"], 2)
+        self.assertEqual(statistics()["calls_skipped"], 1)
+
+    def testSampledConditions(self):
+        @dbc
+        def f(a):
+            """
+            pre[sample=0]: False
+            pre[ sample = 0.5 ]: a > 0
+            """
+            return a
+
+        reset_statistics()
+        f(0)
+        with self.assertRaises(DbcViolation):
+            f(0)
+        self.assertEqual(statistics()["conditions_skipped"], 3)
+
+        @dbc
+        def g(a):
+            """
+            pre[often]: a > 0
+            """
+        with self.assertRaises(AttributeError):
+            g(1)
+
+        @dbc
+        def h(a):
+            """
+            pre[sample=2]: a > 0
+            """
+        with self.assertRaises(ValueError):
+            h(1)
+
+    def testSampledClass(self):
+        @dbc(sample=0.5)
+        class X(object):
+            """
+            hinv: self.bla > 5
+            """
+            def __init__(self):
+                self.bla = 10
+
+            def check(self, value):
+                """
+                pre: value > 0
+                """
+
+        x = X()
+        with self.assertRaises(DbcViolation):
+            x.bla = 0
+        x.bla = 0
+        x.bla = 7
+        self.assertEqual(statistics(X), {"checked": 2, "skipped": 2})
+        x.check(0)
+        with self.assertRaises(DbcViolation):
+            x.check(0)
+
+    def testOnlyConstrainedAttributesChecked(self):
+        @dbc
+        class X(object):
+            """
+            hinv: self.lo <= self.hi
+            """
+            def __init__(self):
+                self.lo = 0
+                self.hi = 10
+                self.other = 0
+
+        x = X()
+        self.assertTrue(hasattr(X.__dict__["lo"], "__set__"))
+        self.assertNotIn("other", X.__dict__)
+        self.assertNotIn("__setattr__", X.__dict__)
+        reset_statistics(X)
+        x.__dict__["lo"] = 20
+        x.other = 5
+        self.assertEqual(statistics(X)["checked"], 0)
+        with self.assertRaises(DbcViolation):
+            x.hi = 15
+        self.assertEqual(statistics(X)["checked"], 1)
+
+    def testConstrainedAttributeAccess(self):
+        @dbc
+        class X(object):
+            """
+            hinv: self.bla > 5
+            hinv: self.blub > 5
+            """
+            bla = 7
+
+            def __init__(self):
+                self.blub = 6
+
+        x = X()
+        self.assertEqual(x.bla, 7)
+        self.assertFalse(hasattr(X(), "missing"))
+        x.bla = 8
+        self.assertEqual(x.bla, 8)
+        self.assertEqual(X().bla, 7)
+        del x.bla
+        self.assertEqual(x.bla, 7)
+        with self.assertRaises(DbcViolation):
+            x.bla = 5
+
+        class Y(X):
+            """
+            hinv: self.blub < 10
+            """
+            pass
+
+        y = Y()
+        y.blub = 8
+        with self.assertRaises(DbcViolation):
+            y.blub = 10
+
+    def testConstrainedAttributeUnset(self):
+        @dbc
+        class Range(object):
+            """
+            hinv: self.lo <= self.hi
+            hinv: self.lo >= 0
+            """
+            def __init__(self, lo, hi):
+                self.lo = lo
+                self.hi = hi
+
+        r = Range(1, 2)
+        # reading lo and hi goes straight to the instance dict
+        self.assertFalse(hasattr(type(Range.__dict__["lo"]), "__get__"))
+        self.assertEqual(r.lo + r.hi, 3)
+        with self.assertRaises(DbcViolation):
+            Range(2, 1)
+        # only invariants reading an attribute not set yet are left out
+        with self.assertRaises(DbcViolation):
+            Range(-1, 2)
+
+    def testInvariantOnProperty(self):
+        @dbc
+        class X(object):
+            """
+            hinv: self.total > 0
+            """
+            def __init__(self):
+                self.a = 1
+                self.b = 1
+
+            @property
+            def total(self):
+                return self.a + self.b
+
+        x = X()
+        x.a = 5
+        with self.assertRaises(DbcViolation):
+            x.b = -5
+
+    def testTransaction(self):
+        @dbc
+        class Range(object):
+            """
+            hinv: self.lo <= self.hi
+            sinv: self.hi - self.lo < 100
+            """
+            def __init__(self):
+                self.lo = 0
+                self.hi = 10
+
+            def width(self):
+                return self.hi - self.lo
+
+        r = Range()
+        with self.assertRaises(DbcViolation):
+            r.lo = 20
+        r.__dict__["lo"] = 0
+
+        reset_statistics(Range)
+        with transaction(r) as t:
+            self.assertIs(t, r)
+            r.lo = 20
+            r.hi = 500
+            self.assertEqual(r.width(), 480)
+            with transaction(r):
+                r.lo = 1000
+            r.lo = 30
+            r.hi = 110
+        self.assertEqual(statistics(Range), {"checked": 1, "skipped": 0})
+
+        with self.assertRaises(DbcViolation):
+            with transaction(r):
+                r.lo = 600
+        r.__dict__["lo"] = 30
+
+        with self.assertRaises(KeyError):
+            with transaction(r):
+                r.lo = 600
+                raise KeyError()
+        r.lo = 30
+        with self.assertRaises(DbcViolation):
+            with transaction(r):
+                r.hi = 1000
+
+    def testTransactionDecorator(self):
+        @dbc
+        class Range(object):
+            """
+            hinv: self.lo <= self.hi
+            """
+            def __init__(self):
+                self.lo = 0
+                self.hi = 10
+
+            @transaction
+            def move(self, lo, hi):
+                """
+                pre: lo <= hi
+                """
+                self.lo = lo
+                self.hi = hi
+
+        r = Range()
+        r.move(20, 30)
+        r.move(0, 5)
+        with self.assertRaises(DbcViolation):
+            r.move(8, 7)
+        self.assertEqual((r.lo, r.hi), (0, 5))
+
+    def testGeneratedSignatureOfWrapper(self):
+        import functools
+
+        def inject(func):
+            @functools.wraps(func)
+            def injected(*args, **kwargs):
+                return func(1, *args, **kwargs)
+            return injected
+
+        @dbc
+        @inject
+        def g(a, b):
+            """
+            post: __ret__ > 0
+            """
+            return a + b
+
+        self.assertEqual(g(2), 3)
+        self.assertEqual(g(b=2), 3)
+
+    def testGeneratedSignature(self):
+        @dbc
+        def f(a, b=2, *args, **kwargs):
+            """
+            pre: a > 0
+            post: __ret__ == a + b + len(args) + len(kwargs)
+            """
+            return a + b + len(args) + len(kwargs)
+
+        self.assertEqual(f(1), 3)
+        self.assertEqual(f(b=3, a=1), 4)
+        self.assertEqual(f(1, 2, 3, 4, x=5), 6)
+        with self.assertRaises(TypeError):
+            f()
+        with self.assertRaises(TypeError):
+            f(1, a=2)
+        with self.assertRaises(DbcViolation):
+            f(0)
+
+    def testGeneratedReservedNames(self):
+        def f(_dbc_x):
+            """
+            pre: _dbc_x
+            """
+        with self.assertRaises(AttributeError):
+            dbc(f)(1)
+
+    def testGeneratedDefaultsAreShared(self):
+        @dbc
+        def f(a, b=[]):
+            """
+            post: len(b) == len(old(b)) + 1
+            """
+            b.append(a)
+            return b
+
+        self.assertIs(f(1), f(2))
+        self.assertEqual(f(3), [1, 2, 3])
+
+    def testProfile(self):
+        @dbc
+        def f(a):
+            """
+            pre: a >= 0
+            post: __ret__ == old(a) + 1
+            """
+            return a + 1
+
+        @dbc
+        class Range(object):
+            """
+            hinv: self.lo <= self.hi
+            """
+            def __init__(self):
+                self.lo = 0
+                self.hi = 10
+
+        reset_profile()
+        f(1)
+        set_profiling(True)
+        try:
+            f(1)
+            f(2)
+            r = Range()
+            r.lo = 5
+            with self.assertRaises(DbcViolation):
+                f(-1)
+            with self.assertRaises(DbcViolation):
+                r.hi = 0
+        finally:
+            set_profiling(False)
+        f(3)
+
+        report = profile()
+        conditions = dict(((r["owner"].split(".")[-1], r["condition"]), r)
+                          for r in report["conditions"])
+        self.assertEqual(conditions["f", "a >= 0"]["count"], 3)
+        self.assertEqual(conditions["f", "__ret__ == old(a) + 1"]["count"], 2)
+        self.assertEqual(conditions["Range", "self.lo <= self.hi"]["count"], 4)
+        self.assertTrue(all(r["max"] <= r["total"] for r in report["conditions"]))
+        self.assertEqual([r["count"] for r in report["snapshots"]], [2])
+        self.assertTrue(report["snapshots"][0]["bytes"] > 0)
+        attributes = dict((r["attribute"], r["checks"]) for r in report["attributes"])
+        self.assertEqual(attributes, {"lo": 2, "hi": 2})
+
+        reset_profile()
+        self.assertEqual(profile(), {"conditions": [], "snapshots": [], "attributes": []})
+
+    def testPredicates(self):
+        self.assertTrue(is_sorted([1, 1, 2]))
+        self.assertFalse(is_sorted([1, 1, 2], strict=True))
+        self.assertFalse(is_sorted([2, 1]))
+        self.assertTrue(is_sorted([]))
+        self.assertFalse(is_sorted(x for x in [1, 3, 2]))
+        self.assertTrue(is_sorted(iter([1, 2, 3]), strict=True))
+        self.assertTrue(non_negative([0, 1.5]))
+        self.assertFalse(non_negative([0, -1]))
+        self.assertTrue(all_finite([1, 2.5]))
+        self.assertFalse(all_finite([1, float("nan")]))
+        self.assertFalse(all_finite([float("-inf")]))
+        self.assertTrue(within_bounds([0, 5, 10], 0, 10))
+        self.assertFalse(within_bounds([0, 11], 0, 10))
+        self.assertTrue(same_shape([[1, 2], [3, 4]], [[0, 0], [0, 0]]))
+        self.assertFalse(same_shape([[1, 2], [3, 4]], [[0, 0], [0]]))
+        self.assertFalse(same_shape([1, 2], [[1], 2]))
+        self.assertTrue(is_permutation([3, 1, 2, 1], [1, 1, 2, 3]))
+        self.assertFalse(is_permutation([3, 1, 2], [1, 1, 2]))
+        self.assertTrue(is_permutation([1, "a"], ["a", 1]))
+        self.assertTrue(unchanged_except([1, 9, 3], [1, 2, 3], [False, True, False]))
+        self.assertFalse(unchanged_except([1, 9, 4], [1, 2, 3], [False, True, False]))
+        self.assertFalse(unchanged_except([1, 2], [1, 2, 3], [False, False, False]))
+
+    def testPredicatesInConditions(self):
+        @dbc
+        def mysort(a):
+            """
+            post: is_sorted(a)
+            post: is_permutation(a, __old__["a"])
+            """
+            a.sort()
+            if len(a) > 3:
+                a[0] = a[-1]
+            return a
+
+        self.assertEqual(mysort([3, 1, 2]), [1, 2, 3])
+        with self.assertRaises(DbcViolation):
+            mysort([4, 3, 1, 2])
+
+        @dbc
+        class Histogram(object):
+            """
+            hinv: non_negative(self.counts)
+            """
+            def __init__(self):
+                self.counts = [0, 0]
+
+        h = Histogram()
+        h.counts = [1, 2]
+        with self.assertRaises(DbcViolation):
+            h.counts = [1, -2]
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def testPredicatesNumPy(self):
+        a = numpy.array([1.0, 2.0, 2.0])
+        self.assertTrue(is_sorted(a))
+        self.assertFalse(is_sorted(a, strict=True))
+        self.assertTrue(non_negative(a))
+        self.assertFalse(all_finite(numpy.array([1.0, numpy.inf])))
+        self.assertTrue(within_bounds(a, 1, 2))
+        self.assertTrue(same_shape(a, numpy.zeros(3)))
+        self.assertFalse(same_shape(a, numpy.zeros((3, 1))))
+        self.assertTrue(is_permutation(a, numpy.array([2.0, 1.0, 2.0])))
+        self.assertTrue(unchanged_except(numpy.array([1.0, 5.0, 2.0]), a,
+                                         numpy.array([False, True, False])))
+        self.assertFalse(unchanged_except(numpy.array([0.0, 5.0, 2.0]), a,
+                                          numpy.array([False, True, False])))
+
+    def testBudgetDemotes(self):
+        @dbc
+        def f(a):
+            """
+            pre: a >= 0
+            post[budget=2]: sum(range(20000)) >= 0
+            """
+            return a
+
+        reset_demotions()
+        with self._budgetLogs():
+            for i in range(3):
+                f(i)
+        self.assertEqual([(d["owner"].split(".")[-1], d["condition"], d["rate"]) for d in demotions()],
+                         [("f", "sum(range(20000)) >= 0", 0.1)])
+        with self.assertRaises(DbcViolation):
+            f(-1)
+
+        reset_statistics()
+        for i in range(11):
+            f(i)
+        self.assertEqual(statistics()["conditions_skipped"], 10)
+        with self._budgetLogs():
+            for i in range(4000):
+                f(i)
+        self.assertEqual([d["rate"] for d in demotions()], [0.1, 0.01, 0.001, 0.0])
+        reset_demotions()
+
+    def testBudgetDefault(self):
+        set_budget("1us")
+        try:
+            @dbc
+            def f(a):
+                """
+                post: sum(range(20000)) >= 0
+                """
+                return a
+        finally:
+            set_budget(None)
+
+        @dbc(budget="10s")
+        def g(a):
+            """
+            post: sum(range(20000)) >= 0
+            """
+            return a
+
+        reset_demotions()
+        with self._budgetLogs():
+            for i in range(3):
+                f(i)
+                g(i)
+        self.assertEqual([d["owner"].split(".")[-1] for d in demotions()], ["f"])
+        reset_demotions()
+
+    def testBudgetInvariant(self):
+        @dbc
+        class X(object):
+            """
+            hinv: self.a >= 0
+            hinv[budget=1us]: sum(range(20000)) + self.a >= 0
+            """
+            def __init__(self):
+                self.a = 0
+
+        reset_demotions()
+        x = X()
+        with self._budgetLogs():
+            for i in range(3):
+                x.a = i
+        self.assertEqual([d["condition"] for d in demotions()], ["sum(range(20000)) + self.a >= 0"])
+        with self.assertRaises(DbcViolation):
+            x.a = -1
+        reset_demotions()
+
+        @dbc
+        class Y(object):
+            """
+            hinv[budget=2x]: self.a >= 0
+            """
+            def __init__(self):
+                self.a = 0
+
+        with self.assertRaises(AttributeError):
+            Y()
+
+    def testClassTablesKept(self):
+        @dbc
+        class X(object):
+            """
+            hinv[budget=10s]: self.a >= 0
+            hinv[sample=0.5]: self.a < 100
+            """
+            def __init__(self):
+                self.a = 0
+
+            def inc(self):
+                self.a += 1
+
+        class Z(X):
+            pass
+
+        X()
+        Z()
+        budgets, samplers, inc = X.__dbc_budgets__, X.__dbc_samplers__, X.__dict__["inc"]
+        z_budgets = Z.__dbc_budgets__
+
+        # decorating another class leaves the tables of X alone
+        @dbc
+        class Y(object):
+            pass
+        X()
+        self.assertIs(X.__dbc_budgets__, budgets)
+        self.assertIs(X.__dbc_samplers__, samplers)
+        self.assertIs(X.__dict__["inc"], inc)
+
+        # re-decorating X rebuilds the tables of X and Z, keeping what the
+        # budgets and samplers have collected
+        dbc(X)
+        X()
+        Z()
+        self.assertIsNot(X.__dbc_budgets__, budgets)
+        self.assertEqual(list(X.__dbc_budgets__.values()), list(budgets.values()))
+        self.assertEqual(list(X.__dbc_samplers__.values()), list(samplers.values()))
+        self.assertEqual(list(Z.__dbc_budgets__.values()), list(z_budgets.values()))
+
+    def _run(self, coroutine):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    @unittest.skipIf(sys.version_info < (3, 5), "coroutines need Python 3.5")
+    def testCoroutine(self):
+        namespace = {"dbc": dbc}
+        exec("""if True:
+            import asyncio, inspect
+
+            @dbc
+            async def double(a, wrong=False):
+                '''
+                pre: a >= 0
+                post: __ret__ == 2 * a
+                '''
+                await asyncio.sleep(0)
+                return 2 * a + wrong
+
+            @dbc
+            async def append(items, x):
+                '''
+                post: len(items) == old(len(items)) + 1
+                '''
+                await asyncio.sleep(0)
+                items.append(x)
+                if x is None:
+                    items.append(x)
+            """, namespace)
+        double = namespace["double"]
+
+        self.assertTrue(namespace["inspect"].iscoroutinefunction(double))
+        self.assertEqual(self._run(double(2)), 4)
+        items = []
+        self._run(namespace["append"](items, 1))
+        with self.assertRaises(DbcViolation):
+            self._run(namespace["append"](items, None))
+        with self.assertRaises(DbcViolation):
+            self._run(double(-1))
+        with self.assertRaises(DbcViolation):
+            self._run(double(2, True))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "coroutines need Python 3.5")
+    def testCoroutineMethod(self):
+        namespace = {"dbc": dbc, "transaction": transaction}
+        exec("""if True:
+            import asyncio
+
+            @dbc
+            class Range(object):
+                '''
+                hinv: self.lo <= self.hi
+                sinv: self.hi - self.lo <= 100
+                '''
+                def __init__(self):
+                    self.lo = 0
+                    self.hi = 10
+
+                async def widen(self, hi):
+                    await asyncio.sleep(0)
+                    self.hi = hi
+
+                @transaction
+                async def move(self, lo, hi):
+                    self.lo = lo
+                    await asyncio.sleep(0)
+                    self.hi = hi
+            """, namespace)
+        r = namespace["Range"]()
+
+        self._run(r.widen(50))
+        with self.assertRaises(DbcViolation):
+            self._run(r.widen(200))
+        r.hi = 50
+        self._run(r.move(80, 90))
+        self.assertEqual((r.lo, r.hi), (80, 90))
+        with self.assertRaises(DbcViolation):
+            self._run(r.move(100, 95))
+
+    def testYieldGenerator(self):
+        @dbc
+        def count(n, step=1):
+            """
+            pre: n >= 0
+            yield: 0 <= __item__ < n
+            yield: __item__ > __prev__
+            yield[sample=0.5]: __item__ % step == 0
+            """
+            i = 0
+            while i < n:
+                yield i
+                i += step
+            yield 0
+
+        items = count(10, 3)
+        self.assertEqual([next(items), next(items), next(items), next(items)], [0, 3, 6, 9])
+        with self.assertRaises(DbcViolation):
+            next(items)
+
+        @dbc
+        def evens(n, extra=0):
+            """
+            yield: __item__ % 2 == 0
+            yield: __index__ < n
+            """
+            return (i for i in range(0, 2 * (n + extra), 2))
+
+        self.assertEqual(list(evens(3)), [0, 2, 4])
+        with self.assertRaises(DbcViolation):
+            list(evens(3, 1))
+
+    @unittest.skipIf(sys.version_info < (3, 6), "async generators need Python 3.6")
+    def testYieldAsyncGenerator(self):
+        namespace = {"dbc": dbc}
+        exec("""if True:
+            @dbc
+            async def count(n):
+                '''
+                yield: __item__ < 2
+                '''
+                for i in range(n):
+                    yield i
+
+            async def consume(items):
+                return [i async for i in items]
+            """, namespace)
+        count, consume = namespace["count"], namespace["consume"]
+
+        self.assertEqual(self._run(consume(count(2))), [0, 1])
+        with self.assertRaises(DbcViolation):
+            self._run(consume(count(3)))
+
+    def testYieldContainer(self):
+        @dbc
+        def squares(n):
+            """
+            yield: __item__ >= 0
+            """
+            return [i * i if i < 5 else -1 for i in range(n)]
+
+        self.assertEqual(squares(3), [0, 1, 4])
+        with self.assertRaises(DbcViolation):
+            squares(6)
+
+        @dbc
+        def found(a):
+            """
+            yield: __item__ >= 0
+            """
+            return None if a is None else a * 2
+
+        self.assertIsNone(found(None))
+        self.assertEqual(found(2), 4)
+
+        def f(a):
+            """
+            yield: __item__ != old(a)
+            """
+            return a
+        with self.assertRaises(AttributeError):
+            dbc(f)([])
+
+    def testThreadCounters(self):
+        import threading
+
+        @dbc
+        def f(a):
+            """
+            pre: a >= 0
+            post: __ret__ == a
+            """
+            return a
+
+        reset_statistics()
+        reset_statistics(f)
+
+        def work():
+            for i in range(2000):
+                f(i)
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for t in threads:
+            t.start()
+        work()
+        for t in threads:
+            t.join()
+        self.assertEqual(statistics(f), {"checked": 18000, "skipped": 0})
+        self.assertEqual(statistics()["calls_checked"], 18000)
+
+    def testThreadCountersDropped(self):
+        def make():
+            @dbc
+            def f(a):
+                """
+                pre: a >= 0
+                """
+            f(1)
+
+        make()
+        gc.collect()
+        before = sum(len(c) for c in sys.modules["dbc"]._thread_counts)
+        for i in range(100):
+            make()
+        gc.collect()
+        self.assertEqual(sum(len(c) for c in sys.modules["dbc"]._thread_counts), before)
+
+    def testThreadTransactions(self):
+        import threading
+
+        @dbc
+        class Range(object):
+            """
+            hinv: self.lo <= self.hi
+            """
+            def __init__(self):
+                self.lo = 0
+                self.hi = 10
+
+        r = Range()
+        entered = threading.Event()
+        done = threading.Event()
+        errors = []
+
+        def other():
+            entered.wait()
+            try:
+                r.hi = -5
+            except DbcViolation as e:
+                errors.append(e)
+            r.__dict__["hi"] = 10
+            done.set()
+
+        t = threading.Thread(target=other)
+        t.start()
+        with transaction(r):
+            r.lo = 20
+            entered.set()
+            done.wait()
+            r.hi = 30
+        t.join()
+        self.assertEqual(len(errors), 1)
+
+    def testSlots(self):
+        @dbc
+        class Point(object):
+            """
+            hinv: self.x >= 0
+            hinv: self.y >= self.x
+            """
+            __slots__ = ("x", "y", "label")
+
+            def __init__(self, x, y):
+                self.x = x
+                self.y = y
+
+            def move(self, dx):
+                """
+                pre: dx >= 0
+                """
+                self.y += dx
+                self.x += dx
+
+        p = Point(1, 2)
+        self.assertFalse(hasattr(p, "__dict__"))
+        p.move(3)
+        self.assertEqual((p.x, p.y), (4, 5))
+        p.label = "a"
+        with self.assertRaises(DbcViolation):
+            p.x = 6
+        with self.assertRaises(DbcViolation):
+            p.move(-1)
+        with self.assertRaises(DbcViolation):
+            Point(-1, 0)
+        del p.y
+        self.assertFalse(hasattr(p, "y"))
+
+        @dbc
+        class Point3(Point):
+            """
+            hinv: self.z >= self.y
+            """
+            __slots__ = ("z",)
+
+            def __init__(self, x, y, z):
+                Point.__init__(self, x, y)
+                self.z = z
+
+        q = Point3(1, 2, 3)
+        self.assertFalse(hasattr(q, "__dict__"))
+        with self.assertRaises(DbcViolation):
+            q.y = 4
+
+    def testSlotsWildcard(self):
+        @dbc
+        class Pair(object):
+            """
+            hinv: self.total() >= 0
+            """
+            __slots__ = ("a", "b")
+
+            def __init__(self):
+                self.a = 0
+                self.b = 0
+
+            def total(self):
+                return self.a + self.b
+
+        p = Pair()
+        self.assertFalse(hasattr(p, "__dict__"))
+        p.a = 5
+        p.b = -5
+        with self.assertRaises(DbcViolation):
+            p.b = -6
+
+    def testStaticAndClassMethods(self):
+        @dbc
+        class Counter(object):
+            """
+            hinv: self.n >= 0
+            sinv: self.n < 10
+            """
+            def __init__(self, n):
+                self.n = n
+
+            @staticmethod
+            def double(x):
+                """
+                pre: x >= 0
+                post: __ret__ == 2 * x
+                """
+                return 2 * x
+
+            @classmethod
+            def make(cls, n):
+                """
+                pre: n < 10
+                """
+                return cls(n)
+
+            @dbc
+            @staticmethod
+            def half(x):
+                """
+                pre: x % 2 == 0
+                """
+                return x // 2
+
+            @staticmethod
+            @dbc
+            def third(x):
+                """
+                pre: x % 3 == 0
+                """
+                return x // 3
+
+        self.assertIsInstance(Counter.__dict__["double"], staticmethod)
+        self.assertEqual(Counter.double(2), 4)
+        self.assertEqual(Counter(1).double(3), 6)
+        with self.assertRaises(DbcViolation):
+            Counter.double(-1)
+        self.assertEqual(Counter.make(5).n, 5)
+        with self.assertRaises(DbcViolation):
+            Counter.make(10)
+        self.assertEqual(Counter.half(4), 2)
+        with self.assertRaises(DbcViolation):
+            Counter.half(3)
+        self.assertEqual(Counter.third(6), 2)
+        with self.assertRaises(DbcViolation):
+            Counter.third(4)
+
+    def testCache(self):
+        import os
+        import shutil
+        import tempfile
+
+        def make(default=1):
+            def f(a, b=default):
+                """
+                pre: a >= 0
+                post: __ret__ == old(a) + b
+                """
+                return a + b
+            return f
+
+        directory = tempfile.mkdtemp()
+        try:
+            set_cache_dir(directory)
+            clear_cache()
+            f = prepare(dbc(make()))
+            self.assertEqual(cache_info()["misses"], 1)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            prepare(dbc(make()))
+            self.assertEqual(cache_info()["hits"], 1)
+
+            # a new process only finds the file
+            clear_cache()
+            g = prepare(dbc(make()))
+            self.assertEqual(cache_info(), {"hits": 1, "misses": 0, "entries": 1})
+            self.assertEqual(g(1), f(1))
+            with self.assertRaises(DbcViolation):
+                g(-1)
+
+            # the key does not depend on the values of defaults
+            k = prepare(dbc(make(5)))
+            self.assertEqual(cache_info()["hits"], 2)
+            self.assertEqual(k(1), 6)
+
+            # files that cannot be read are compiled anew
+            for name in os.listdir(directory):
+                with open(os.path.join(directory, name), "wb") as out:
+                    out.write(b"garbage")
+            clear_cache()
+            h = prepare(dbc(make()))
+            self.assertEqual(cache_info()["misses"], 1)
+            self.assertEqual(h(2), 3)
+        finally:
+            set_cache_dir(None)
+            shutil.rmtree(directory)
+
+    def testLazyPreparation(self):
+        def f(a, b=2):
+            """
+            pre: a >
+            """
+            return a + b
+        g = dbc(f)
+        self.assertEqual(g.__name__, "f")
+        self.assertIs(g.__dbc_func__, f)
+        with self.assertRaises(SyntaxError):
+            g(1)
+
+        @dbc
+        def h(a, b=2):
+            """
+            pre: a > 0
+            """
+            return a + b
+        self.assertFalse(hasattr(h, "__pres__"))
+        code = h.__code__
+        self.assertEqual(h(1), 3)
+        self.assertIsNot(h.__code__, code)
+        self.assertEqual(h.__defaults__, (2,))
+        self.assertEqual(len(h.__pres__), 1)
+        with self.assertRaises(DbcViolation):
+            h(0)
+
+    def testPrepareAll(self):
+        @dbc
+        def f(a):
+            """
+            pre: a
+            """
+
+        @dbc
+        class X(object):
+            """
+            hinv: self.a >= 0
+            """
+            def __init__(self):
+                self.a = 0
+
+            def inc(self, n):
+                """
+                pre: n > 0
+                """
+                self.a += n
+
+        @dbc
+        def g(a):
+            """
+            pre: old(a)
+            """
+
+        @dbc
+        def h(a):
+            """
+            pre: old(a)
+            """
+
+        # what fails, here or left over from other tests, does not stop the
+        # rest from being prepared
+        gc.collect()
+        with self.assertRaises(AttributeError) as cm:
+            prepare_all()
+        self.assertEqual(len(f.__pres__), 1)
+        self.assertEqual(len(X.__dict__["inc"].__pres__), 1)
+        X().inc(1)
+        failed = [elem for elem, e in cm.exception.errors]
+        self.assertIn(g, failed)
+        self.assertIn(h, failed)
+        del g, h, failed, cm
+
+    def testLazyPreparationThreads(self):
+        import threading
+
+        @dbc
+        def f(a):
+            """
+            pre: a >= 0
+            post: __ret__ == old(a) + 1
+            """
+            return a + 1
+
+        results = []
+        start = threading.Event()
+
+        def run():
+            start.wait()
+            results.append(f(1))
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [2] * 8)
+        self.assertEqual(len(f.__posts__), 1)
+
+    def testDeferred(self):
+        @dbc
+        def f(a, b=1):
+            """
+            pre: a >= 0
+            post[defer]: __ret__ == old(a) + b
+            post[defer]: a != 13
+            """
+            return 0 if a == 5 else a + b
+
+        self.assertEqual(f(1), 2)
+        flush()
+        self.assertEqual(f(5), 0)
+        with self.assertRaises(DbcViolation) as cm:
+            flush()
+        self.assertEqual(cm.exception.con, "__ret__ == old(a) + b")
+        flush()
+
+        got = []
+        set_deferred(handler=got.append)
+        try:
+            f(13)
+            flush()
+            self.assertEqual([e.con for e in got], ["a != 13"])
+        finally:
+            set_deferred()
+
+        @dbc
+        def g(a):
+            """
+            pre[defer]: a
+            """
+        with self.assertRaises(AttributeError):
+            g(1)
+
+    def testDeferredSnapshots(self):
+        import threading
+
+        class Gate(object):
+            def __init__(self):
+                self.event = threading.Event()
+
+            def __dbc_snapshot__(self):
+                return self
+
+        @dbc
+        def f(a, gate):
+            """
+            post[defer]: gate.event.wait(5) and __ret__ == [sum(a)] and len(a) == 2
+            """
+            return [sum(a)]
+
+        gate = Gate()
+        a = [1, 2]
+        ret = f(a, gate)
+        # what the caller changes afterwards is not seen by the check
+        a.append(3)
+        ret.append(4)
+        gate.event.set()
+        flush()
+
+    def testDeferredBackpressure(self):
+        import threading
+
+        class Event(object):
+            # shared with the deferred check rather than snapshot
+            def __init__(self):
+                self.event = threading.Event()
+
+            def __dbc_snapshot__(self):
+                return self
+
+        @dbc
+        def f(started, gate):
+            """
+            post[defer]: started.event.set() or gate.event.wait(5)
+            """
+
+        for overflow, counter in (("drop", "dropped"), ("inline", "inline")):
+            set_deferred(queue_size=1, overflow=overflow)
+            try:
+                started, gate, done = Event(), Event(), Event()
+                done.event.set()
+                before = deferred_info()
+                f(started, gate)
+                started.event.wait(5)
+                f(Event(), gate)
+                f(Event(), done)
+                info = deferred_info()
+                self.assertEqual(info["queued"] - before["queued"], 2)
+                self.assertEqual(info[counter] - before[counter], 1)
+                gate.event.set()
+                flush()
+            finally:
+                set_deferred()
+
+    def testReport(self):
+        @dbc
+        def f(a, b=1):
+            """
+            pre: a >= 0
+            post: __ret__ > a
+            """
+            return a - b
+
+        reset_violations()
+        set_report(capture=2)
+        try:
+            for i in range(5):
+                self.assertEqual(f(-1), -2)
+        finally:
+            set_report(False)
+        with self.assertRaises(DbcViolation):
+            f(-1)
+
+        report = violations()
+        self.assertEqual(report["counts"], {"a >= 0": 5, "__ret__ > a": 5})
+        self.assertEqual(len(report["recent"]), 10)
+        first = report["recent"][0]
+        self.assertEqual((first["condition"], first["count"]), ("a >= 0", 1))
+        self.assertEqual(first["values"], {"a": "-1", "b": "1"})
+        self.assertEqual(report["recent"][1]["values"], {"a": "-1", "b": "1", "__ret__": "-2"})
+        self.assertIsNone(report["recent"][-1]["values"])
+        reset_violations()
+        self.assertEqual(violations(), {"counts": {}, "recent": [], "suppressed": 0})
+
+    def testReportOption(self):
+        @dbc(report=True)
+        def f(a):
+            """
+            pre: a >= 0
+            """
+            return a
+
+        @dbc(report=True)
+        class X(object):
+            """
+            hinv: self.a >= 0
+            """
+            def __init__(self):
+                self.a = 0
+
+        handled = []
+        reset_violations()
+        set_report(False, size=3, handler=handled.append, handler_rate=1e-6)
+        try:
+            for i in range(3):
+                f(-1)
+            x = X()
+            x.a = -1
+            self.assertEqual(x.a, -1)
+        finally:
+            set_report(False)
+        report = violations()
+        self.assertEqual(report["counts"], {"a >= 0": 3, "self.a >= 0": 1})
+        self.assertEqual([r["condition"] for r in report["recent"]], ["a >= 0", "a >= 0", "self.a >= 0"])
+        self.assertEqual(len(handled), 1)
+        self.assertEqual(report["suppressed"], 3)
+        reset_violations()
+
+    def testMemo(self):
+        @dbc(memo=2)
+        def f(a, b=(), c=None):
+            """
+            pre: a >= 0
+            pre: isinstance(a, int)
+            pre: len(b) < 3
+            """
+            return a
+
+        for a in (1, 1, 2, 1, 3, 2):
+            f(a)
+        self.assertEqual(memo_info(f), {"hits": 2, "misses": 4, "uncacheable": 0,
+                                        "size": 2, "maxsize": 2})
+        f(3, c=[])
+        self.assertEqual(memo_info(f)["hits"], 3)
+        with self.assertRaises(DbcViolation):
+            f(-1)
+        with self.assertRaises(DbcViolation):
+            f(-1)
+        with self.assertRaises(DbcViolation):
+            f(1.0)
+        f(1, [])
+        f(1, [])
+        self.assertEqual(memo_info(f)["uncacheable"], 2)
+        clear_memo(f)
+        self.assertEqual(memo_info(f)["size"], 0)
+
+    def testMemoSignedZero(self):
+        @dbc(memo=8)
+        def z(x):
+            """
+            pre: "-" not in str(x)
+            """
+            return x
+
+        # equal, but not the same
+        for x, y in ((0.0, -0.0), ((0.0,), (-0.0,)), (frozenset([0.0]), frozenset([-0.0])),
+                     (complex(1, 0.0), complex(1, -0.0))):
+            z(x)
+            with self.assertRaises(DbcViolation):
+                z(y)
+        self.assertEqual(memo_info(z)["hits"], 0)
+
+    def testMemoSkipsSelf(self):
+        class X(object):
+            def __init__(self):
+                self.n = 0
+
+            @dbc(memo=10)
+            def f(self, a):
+                """
+                pre: a > self.n
+                pre: a < 10
+                """
+                self.n = a
+
+        x = X()
+        x.f(1)
+        with self.assertRaises(DbcViolation):
+            x.f(1)
+        self.assertEqual(memo_info(X.__dict__["f"])["hits"], 1)
+        with self.assertRaises(AttributeError):
+            dbc(X, memo=10)
+
+    def testOptimizedConditions(self):
+        @dbc
+        def f(a):
+            """
+            pre: isinstance(a, list)
+            pre: a[0] > 0
+            post: len(__ret__) > 2 - 1
+            post: len(__ret__) < 2 * 5
+            post: 1 < 2
+            """
+            return a[1:]
+
+        self.assertEqual(f([1, 2, 3]), [2, 3])
+        self.assertIn("_dbc_post0", f.__code__.co_varnames)
+        for args, con in ((([1],), "len(__ret__) > 2 - 1"), (([1] * 12,), "len(__ret__) < 2 * 5"),
+                          (([0, 1],), "a[0] > 0"), ((5,), "isinstance(a, list)")):
+            try:
+                f(*args)
+            except DbcViolation as e:
+                self.assertEqual(e.con, con)
+            else:
+                self.fail("DbcViolation not raised")
+
+    def testOptimizedConditionsReported(self):
+        @dbc(report=True)
+        def f(x, y):
+            """
+            pre: isinstance(x, list)
+            pre: y > 0
+            pre: x[0] > 0
+            """
+
+        reset_violations()
+        try:
+            # x[0] fails on 5 in the check as written, too
+            with self.assertRaises(TypeError):
+                f(5, -1)
+            self.assertEqual(violations()["counts"], {"isinstance(x, list)": 1, "y > 0": 1})
+        finally:
+            reset_violations()
+
+    def testInvariantsAtMethods(self):
+        @dbc(invariants="methods")
+        class Account(object):
+            """
+            hinv: self.balance >= 0
+            sinv: self._counted()
+            """
+            def __init__(self, balance=0):
+                self.checks = 0
+                self.balance = balance
+
+            def _counted(self):
+                self.checks += 1
+                return True
+
+            def move(self, amount):
+                self.balance -= 1000
+                self.balance += 1000 + amount
+                self.deposit(0)
+
+            def deposit(self, amount):
+                self.balance += amount
+
+            def _overdraw(self):
+                self.balance = -1
+
+        a = Account()
+        self.assertEqual(a.checks, 1)
+        a.move(5)
+        self.assertEqual((a.balance, a.checks), (5, 3))
+        a.balance = -5
+        with self.assertRaises(DbcViolation):
+            a.deposit(1)
+        a.balance = 0
+        a._overdraw()
+        with self.assertRaises(DbcViolation):
+            a.move(1)
+        with self.assertRaises(DbcViolation):
+            Account(-1)
+
+        class Savings(Account):
+            def __init__(self):
+                Account.__init__(self, -1)
+                self.balance = 1
+        Savings = dbc(Savings, invariants="methods")
+        self.assertEqual(Savings().checks, 1)
+
+        with self.assertRaises(AttributeError):
+            dbc(lambda: None, invariants="methods")
+        with self.assertRaises(ValueError):
+            dbc(Account, invariants="calls")
+
+    @unittest.skipIf(sys.version_info < (3, 5), "coroutines need Python 3.5")
+    def testInvariantsAtAsyncMethods(self):
+        namespace = {"dbc": dbc, "transaction": transaction}
+        exec("""if True:
+            import asyncio
+
+            @dbc(invariants="methods")
+            class Range(object):
+                '''
+                hinv: self.lo <= self.hi
+                '''
+                def __init__(self):
+                    self.lo = 0
+                    self.hi = 10
+
+                async def widen(self, hi):
+                    await asyncio.sleep(0)
+                    self.hi = hi
+
+            async def move(r, lo, hi):
+                with transaction(r):
+                    r.lo = lo
+                    await asyncio.sleep(0)
+                    await asyncio.sleep(0)
+                    r.hi = hi
+
+            async def both(r):
+                await asyncio.gather(r.widen(50), move(r, 30, 40))
+            """, namespace)
+        r = namespace["Range"]()
+
+        # the method ends while the transaction is still open
+        self._run(namespace["both"](r))
+        self.assertEqual((r.lo, r.hi), (30, 40))
+        with self.assertRaises(DbcViolation):
+            self._run(r.widen(10))
+
+    def testSampledConditionsPerOwner(self):
+        def make():
+            def f(a):
+                """
+                pre[sample=0.5]: a > 0
+                """
+            return dbc(f)
+        f, g = make(), make()
+        # alternating calls would all be checked for one of them, and never
+        # for the other, if they shared the credit of their sampler
+        violations = {f: 0, g: 0}
+        for i in range(10):
+            for h in (f, g):
+                try:
+                    h(0)
+                except DbcViolation:
+                    violations[h] += 1
+        self.assertEqual(list(violations.values()), [5, 5])
+
 if __name__ == "__main__":
     unittest.main()